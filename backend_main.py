@@ -4,19 +4,31 @@ FastAPI + PostgreSQL + Redis
 Railway deployment ready
 """
 
-from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect, Header
+from fastapi import FastAPI, HTTPException, WebSocket, Header, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field
-from typing import List, Optional, Dict, Any
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field, TypeAdapter, ValidationError
+from typing import List, Optional, Dict, Any, Set, Tuple
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import RealDictCursor, execute_values
+from psycopg2.pool import ThreadedConnectionPool
 import redis
+import redis.asyncio as aioredis
+import base64
+import bisect
+import hashlib
+import heapq
 import json
 import uuid
 import os
-from datetime import datetime
+import random
+import socket
+import time
+from datetime import datetime, timedelta
 import asyncio
-from contextlib import asynccontextmanager
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
 
 DATABASE_URL = os.getenv("DATABASE_URL")
 if not DATABASE_URL:
@@ -36,14 +48,332 @@ if not MASTER_REGISTRATION_TOKEN:
 CORS_ORIGINS_STR = os.getenv("CORS_ORIGINS", "*")
 CORS_ORIGINS = ["*"] if CORS_ORIGINS_STR == "*" else CORS_ORIGINS_STR.split(",")
 
-db_conn = None
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "2"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "20"))
+DB_POOL_VALIDATE_AFTER = float(os.getenv("DB_POOL_VALIDATE_AFTER", "30"))  # idle seconds before a checkout ping
+
+EXPORT_MAX_CONCURRENCY = int(os.getenv("EXPORT_MAX_CONCURRENCY", "4"))
+EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", "500"))
+PAGE_MAX_LIMIT = int(os.getenv("PAGE_MAX_LIMIT", "500"))
+
+CHECK_CACHE_MAX_ENTRIES = int(os.getenv("CHECK_CACHE_MAX_ENTRIES", "1000"))
+CHECK_CACHE_MAX_BYTES = int(os.getenv("CHECK_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+CHECK_CACHE_TTL = int(os.getenv("CHECK_CACHE_TTL", "86400"))
+CHECK_MICRO_CACHE_TTL = float(os.getenv("CHECK_MICRO_CACHE_TTL", "1"))
+CHECK_JSON_IN_DB = os.getenv("CHECK_JSON_IN_DB", "true").lower() == "true"
+
+MIGRATE_ON_STARTUP = os.getenv("MIGRATE_ON_STARTUP", "false").lower() == "true"
+PARTITION_MONTHS_AHEAD = int(os.getenv("PARTITION_MONTHS_AHEAD", "2"))
+PARTITION_MAINTENANCE_INTERVAL = float(os.getenv("PARTITION_MAINTENANCE_INTERVAL", "3600"))
+CHECK_RESULTS_RETENTION_DAYS = int(os.getenv("CHECK_RESULTS_RETENTION_DAYS", "0"))  # 0 = keep forever
+ROLLUP_MINUTE_RETENTION_DAYS = int(os.getenv("ROLLUP_MINUTE_RETENTION_DAYS", "7"))
+ROLLUP_HOUR_RETENTION_DAYS = int(os.getenv("ROLLUP_HOUR_RETENTION_DAYS", "0"))  # 0 = keep forever
+ROLLUP_MINUTE_MAX_RANGE_HOURS = int(os.getenv("ROLLUP_MINUTE_MAX_RANGE_HOURS", "6"))
+
+AGENT_OFFLINE_AFTER = int(os.getenv("AGENT_OFFLINE_AFTER", "60"))
+HEARTBEAT_FLUSH_INTERVAL = float(os.getenv("HEARTBEAT_FLUSH_INTERVAL", "5"))
+HEARTBEAT_RETENTION = int(os.getenv("HEARTBEAT_RETENTION", "86400"))
+AGENT_SWEEP_INTERVAL = float(os.getenv("AGENT_SWEEP_INTERVAL", "10"))
+
+AGENT_CACHE_MAX_SIZE = int(os.getenv("AGENT_CACHE_MAX_SIZE", "100000"))
+AGENT_CACHE_TTL = float(os.getenv("AGENT_CACHE_TTL", "3600"))
+AGENT_CACHE_NEGATIVE_TTL = float(os.getenv("AGENT_CACHE_NEGATIVE_TTL", "30"))
+
+RESULT_MAX_SIZE = 100000
+RESULT_BATCH_MAX_SIZE = int(os.getenv("RESULT_BATCH_MAX_SIZE", "5000"))
+
+TASK_PAYLOAD_TTL = int(os.getenv("TASK_PAYLOAD_TTL", "3600"))
+TASK_DEADLINE = int(os.getenv("TASK_DEADLINE", "600"))  # 0 = tasks never expire
+TASK_QUEUE_MAX_LENGTH = int(os.getenv("TASK_QUEUE_MAX_LENGTH", "10000"))  # 0 = unbounded
+TASK_QUEUE_DROP_POLICY = os.getenv("TASK_QUEUE_DROP_POLICY", "drop_oldest")  # drop_oldest | drop_newest
+TASK_QUEUE_BACKEND = os.getenv("TASK_QUEUE_BACKEND", "list")  # list | stream
+TASK_CLAIM_TIMEOUT = int(os.getenv("TASK_CLAIM_TIMEOUT", "120"))
+TASK_ORPHAN_AFTER = int(os.getenv("TASK_ORPHAN_AFTER", "120"))
+TASK_SWEEP_INTERVAL = float(os.getenv("TASK_SWEEP_INTERVAL", "5"))
+TASK_SWEEP_BATCH = int(os.getenv("TASK_SWEEP_BATCH", "500"))
+CHECK_RESULT_GRACE = int(os.getenv("CHECK_RESULT_GRACE", "120"))
+CHECK_COUNTER_TTL = int(os.getenv("CHECK_COUNTER_TTL", "86400"))
+SCHEDULE_MIN_INTERVAL = int(os.getenv("SCHEDULE_MIN_INTERVAL", "10"))
+SCHEDULER_BATCH_SIZE = int(os.getenv("SCHEDULER_BATCH_SIZE", "1000"))
+SCHEDULER_RELOAD_INTERVAL = float(os.getenv("SCHEDULER_RELOAD_INTERVAL", "15"))
+SCHEDULER_LEADER_TTL = float(os.getenv("SCHEDULER_LEADER_TTL", "15"))
+
+CHECK_COALESCE_WINDOW = int(os.getenv("CHECK_COALESCE_WINDOW", "30"))  # 0 disables coalescing
+CHECK_COALESCE_CLAIM_WAIT = float(os.getenv("CHECK_COALESCE_CLAIM_WAIT", "5"))  # seconds to wait on another worker's claim
+TASK_FETCH_MAX_LIMIT = int(os.getenv("TASK_FETCH_MAX_LIMIT", "100"))
+AGENT_LOAD_REFRESH_INTERVAL = float(os.getenv("AGENT_LOAD_REFRESH_INTERVAL", "2"))
+AGENT_MAX_BACKLOG = int(os.getenv("AGENT_MAX_BACKLOG", "1000"))  # 0 disables the backlog cutoff
+AGENT_LATENCY_WINDOW = int(os.getenv("AGENT_LATENCY_WINDOW", "5"))  # minutes
+AGENT_DEFAULT_TASK_MS = float(os.getenv("AGENT_DEFAULT_TASK_MS", "1000"))
+TASK_LONG_POLL_MAX_WAIT = float(os.getenv("TASK_LONG_POLL_MAX_WAIT", "30"))
+
+WS_SEND_QUEUE_SIZE = int(os.getenv("WS_SEND_QUEUE_SIZE", "100"))
+WS_SLOW_CONSUMER_POLICY = os.getenv("WS_SLOW_CONSUMER_POLICY", "drop")  # drop | disconnect
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+COMPLETION_BUCKETS = (0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+def _escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _metric_labels(names: Tuple[str, ...], values: Tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Histogram:
+    """Fixed-bucket Prometheus histogram. Only touched from the event loop, so no locking."""
+
+    def __init__(self, name: str, help_text: str, label_names: Tuple[str, ...], buckets: Tuple[float, ...]):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self.series: Dict[Tuple, list] = {}
+
+    def observe(self, value: float, *labels):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [[0] * len(self.buckets), 0.0, 0]
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            series[0][index] += 1
+        series[1] += value
+        series[2] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total, count) in self.series.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = 'le="%s"' % bound
+                lines.append(f"{self.name}_bucket{_metric_labels(self.label_names, labels, le)} {cumulative}")
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{_metric_labels(self.label_names, labels, le)} {count}")
+            lines.append(f"{self.name}_sum{_metric_labels(self.label_names, labels)} {total}")
+            lines.append(f"{self.name}_count{_metric_labels(self.label_names, labels)} {count}")
+        return lines
+
+class Counter:
+    def __init__(self, name: str, help_text: str, label_names: Tuple[str, ...]):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.values: Dict[Tuple, float] = {}
+
+    def inc(self, amount: float, *labels):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for labels, value in self.values.items():
+            lines.append(f"{self.name}{_metric_labels(self.label_names, labels)} {value}")
+        return lines
+
+http_request_duration = Histogram(
+    "http_request_duration_seconds", "HTTP request latency by route",
+    ("method", "route", "status"), LATENCY_BUCKETS)
+db_query_duration = Histogram(
+    "db_query_duration_seconds", "Database call latency by query function, including pool wait",
+    ("query",), LATENCY_BUCKETS)
+redis_command_duration = Histogram(
+    "redis_command_duration_seconds", "Redis round-trip latency by command, script or pipeline",
+    ("command",), LATENCY_BUCKETS)
+check_completion_duration = Histogram(
+    "check_completion_seconds", "Time from check created_at to completed_at",
+    ("outcome",), COMPLETION_BUCKETS)
+results_ingested = Counter(
+    "results_ingested_total", "Check results written to check_results",
+    ("source",))
+
+class MetricsMiddleware:
+    """Plain ASGI middleware: times each HTTP request under its route template."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        
+        status = [500]
+        
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+        
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            # The router stores the matched route on the shared scope
+            route = getattr(scope.get("route"), "path", "unmatched")
+            http_request_duration.observe(time.perf_counter() - start, scope["method"], route, status[0])
+
+_redis_script_names: Dict[str, str] = {}
+
+def redis_command_name(args: tuple) -> str:
+    command = str(args[0]).upper()
+    if command == "EVAL" and len(args) > 1:
+        if not _redis_script_names:
+            _redis_script_names.update({
+                value: name.lower() for name, value in globals().items()
+                if name.endswith("_SCRIPT") and isinstance(value, str)
+            })
+        return _redis_script_names.get(args[1], "EVAL")
+    return command
+
+class InstrumentedPipeline(aioredis.client.Pipeline):
+    async def execute(self, raise_on_error: bool = True):
+        start = time.perf_counter()
+        try:
+            return await super().execute(raise_on_error)
+        finally:
+            redis_command_duration.observe(time.perf_counter() - start, "pipeline")
+
+class InstrumentedRedis(aioredis.Redis):
+    async def execute_command(self, *args, **options):
+        start = time.perf_counter()
+        try:
+            return await super().execute_command(*args, **options)
+        finally:
+            redis_command_duration.observe(time.perf_counter() - start, redis_command_name(args))
+
+    def pipeline(self, transaction: bool = True, shard_hint: Optional[str] = None):
+        return InstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+db_pool = None
+db_executor = None
 redis_client = None
+async_redis_client = None
+
+def get_db_pool() -> ThreadedConnectionPool:
+    global db_pool
+    if db_pool is None or db_pool.closed:
+        # Streaming exports hold a connection outside the executor, so they
+        # get their own headroom on top of one connection per worker thread.
+        db_pool = ThreadedConnectionPool(DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE + EXPORT_MAX_CONCURRENCY, DATABASE_URL)
+    return db_pool
+
+def get_db_executor() -> ThreadPoolExecutor:
+    # One worker per pooled connection: blocking queries never wait on the
+    # event loop, and the pool can never be exhausted by our own threads.
+    global db_executor
+    if db_executor is None:
+        db_executor = ThreadPoolExecutor(max_workers=DB_POOL_MAX_SIZE, thread_name_prefix="db")
+    return db_executor
+
+# id(conn) -> when it was last returned to the pool
+connection_returned_at: Dict[int, float] = {}
+
+def _connection_alive(conn) -> bool:
+    if conn.closed or conn.info.transaction_status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+        return False
+    # The client-side flags don't notice a server or proxy dropping an idle
+    # connection, so anything idle for a while gets a round trip first
+    if time.monotonic() - connection_returned_at.get(id(conn), 0) < DB_POOL_VALIDATE_AFTER:
+        return True
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT 1")
+        cursor.close()
+        conn.rollback()
+        return True
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        return False
+
+def _release_connection(pool: ThreadedConnectionPool, conn, close: bool = False):
+    if close:
+        connection_returned_at.pop(id(conn), None)
+    else:
+        connection_returned_at[id(conn)] = time.monotonic()
+    pool.putconn(conn, close=close)
+
+def _checkout_connection(pool: ThreadedConnectionPool):
+    for _ in range(DB_POOL_MAX_SIZE + 1):
+        conn = pool.getconn()
+        if _connection_alive(conn):
+            return conn
+        _release_connection(pool, conn, close=True)
+    raise psycopg2.OperationalError("No healthy database connection available")
 
+@contextmanager
 def get_db():
-    global db_conn
-    if db_conn is None or db_conn.closed:
-        db_conn = psycopg2.connect(DATABASE_URL)
-    return db_conn
+    """Check out a pooled connection; commit on success, roll back on error."""
+    pool = get_db_pool()
+    conn = _checkout_connection(pool)
+    broken = False
+    try:
+        yield conn
+        conn.commit()
+    except Exception as e:
+        broken = conn.closed or isinstance(e, (psycopg2.OperationalError, psycopg2.InterfaceError))
+        if not conn.closed:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                broken = True
+        raise
+    finally:
+        _release_connection(pool, conn, close=broken)
+
+async def run_db(fn, *args):
+    """Run fn(conn, *args) on a pooled connection without blocking the event loop."""
+    def _run():
+        with get_db() as conn:
+            return fn(conn, *args)
+    loop = asyncio.get_running_loop()
+    start = time.perf_counter()
+    try:
+        return await loop.run_in_executor(get_db_executor(), _run)
+    finally:
+        db_query_duration.observe(time.perf_counter() - start, fn.__name__.lstrip("_"))
+
+export_slots = asyncio.Semaphore(EXPORT_MAX_CONCURRENCY)
+
+async def stream_db(query: str, params: tuple, chunk_size: int):
+    """Yield row chunks from a server-side cursor held open for the whole stream."""
+    loop = asyncio.get_running_loop()
+    executor = get_db_executor()
+    pool = get_db_pool()
+    
+    async with export_slots:
+        conn = await loop.run_in_executor(executor, _checkout_connection, pool)
+        broken = False
+        try:
+            cursor = conn.cursor(name=f"export_{uuid.uuid4().hex}", cursor_factory=RealDictCursor)
+            await loop.run_in_executor(executor, cursor.execute, query, params)
+            while True:
+                rows = await loop.run_in_executor(executor, cursor.fetchmany, chunk_size)
+                if not rows:
+                    break
+                yield rows
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        finally:
+            def release():
+                # Read-only: rolling back also closes the named cursor
+                close = broken or conn.closed
+                if not close:
+                    try:
+                        conn.rollback()
+                    except psycopg2.Error:
+                        close = True
+                _release_connection(pool, conn, close=close)
+            await loop.run_in_executor(executor, release)
+
+def close_db():
+    global db_pool, db_executor
+    if db_executor is not None:
+        db_executor.shutdown(wait=True)
+        db_executor = None
+    if db_pool is not None and not db_pool.closed:
+        db_pool.closeall()
+    db_pool = None
 
 def get_redis():
     global redis_client
@@ -51,14 +381,288 @@ def get_redis():
         redis_client = redis.from_url(REDIS_URL, decode_responses=True)
     return redis_client
 
-@asynccontextmanager
-async def lifespan(app: FastAPI):
-    print("🚀 Starting Host Checker Backend...")
-    
-    conn = get_db()
+def get_async_redis():
+    global async_redis_client
+    if async_redis_client is None:
+        async_redis_client = InstrumentedRedis.from_url(REDIS_URL, decode_responses=True)
+    return async_redis_client
+
+CHECK_UPDATES_PATTERN = "check:*:updates"
+
+class CheckUpdatesHub:
+    """One Redis pattern subscription per worker, fanned out to local WebSockets."""
+
+    def __init__(self, queue_size: int, slow_consumer_policy: str):
+        self.queue_size = queue_size
+        self.slow_consumer_policy = slow_consumer_policy
+        self.subscribers: Dict[str, Set[asyncio.Queue]] = {}
+        self.dropped_messages = 0
+        self.disconnected_consumers = 0
+        self._task: Optional[asyncio.Task] = None
+
+    def subscribe(self, check_id: str) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        self.subscribers.setdefault(check_id, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, check_id: str, queue: asyncio.Queue):
+        queues = self.subscribers.get(check_id)
+        if queues is None:
+            return
+        queues.discard(queue)
+        if not queues:
+            del self.subscribers[check_id]
+
+    def dispatch(self, check_id: str, data: str):
+        for queue in list(self.subscribers.get(check_id, ())):
+            try:
+                queue.put_nowait(data)
+            except asyncio.QueueFull:
+                self._handle_slow_consumer(check_id, queue, data)
+
+    def _handle_slow_consumer(self, check_id: str, queue: asyncio.Queue, data: str):
+        if self.slow_consumer_policy == "disconnect":
+            # Replace the backlog with a close sentinel; the socket's sender
+            # closes the connection when it reaches it.
+            while not queue.empty():
+                queue.get_nowait()
+            queue.put_nowait(None)
+            self.unsubscribe(check_id, queue)
+            self.disconnected_consumers += 1
+        else:
+            queue.get_nowait()
+            queue.put_nowait(data)
+            self.dropped_messages += 1
+
+    async def _listen(self):
+        while True:
+            pubsub = get_async_redis().pubsub()
+            try:
+                await pubsub.psubscribe(CHECK_UPDATES_PATTERN)
+                async for message in pubsub.listen():
+                    if message["type"] != "pmessage":
+                        continue
+                    check_id = message["channel"].split(":", 2)[1]
+                    self.dispatch(check_id, message["data"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Check updates hub error: {e}")
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.reset()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._listen())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        for queues in self.subscribers.values():
+            for queue in queues:
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(None)
+        self.subscribers.clear()
+
+check_updates_hub = CheckUpdatesHub(WS_SEND_QUEUE_SIZE, WS_SLOW_CONSUMER_POLICY)
+
+AGENT_IDENTITY_CHANNEL = "agents:identity"
+
+class AgentIdentityCache:
+    """Bounded TTL/LRU map of agent id -> exists, with shorter-lived negative entries."""
+
+    def __init__(self, max_size: int, ttl: float, negative_ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, Tuple[bool, float]]" = OrderedDict()
+
+    def get(self, agent_id: str) -> Optional[bool]:
+        entry = self._entries.get(agent_id)
+        if entry is None or entry[1] < time.monotonic():
+            if entry is not None:
+                del self._entries[agent_id]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(agent_id)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, agent_id: str, known: bool):
+        expires = time.monotonic() + (self.ttl if known else self.negative_ttl)
+        self._entries[agent_id] = (known, expires)
+        self._entries.move_to_end(agent_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def discard(self, agent_ids: List[str]):
+        for agent_id in agent_ids:
+            self._entries.pop(agent_id, None)
+
+    def clear(self):
+        self._entries.clear()
+
+agent_identity_cache = AgentIdentityCache(AGENT_CACHE_MAX_SIZE, AGENT_CACHE_TTL, AGENT_CACHE_NEGATIVE_TTL)
+
+def _fetch_agent_ids(conn, limit: int) -> List[str]:
+    cursor = conn.cursor()
+    cursor.execute("SELECT id FROM agents ORDER BY registered_at DESC LIMIT %s", (limit,))
+    agent_ids = [row[0] for row in cursor.fetchall()]
+    cursor.close()
+    return agent_ids
+
+def _known_agents(conn, agent_ids: List[str]) -> Set[str]:
     cursor = conn.cursor()
+    cursor.execute("SELECT id FROM agents WHERE id = ANY(%s)", (agent_ids,))
+    found = {row[0] for row in cursor.fetchall()}
+    cursor.close()
+    return found
+
+async def warm_agent_identity_cache():
+    for agent_id in reversed(await run_db(_fetch_agent_ids, AGENT_CACHE_MAX_SIZE)):
+        agent_identity_cache.put(agent_id, True)
+
+async def known_agents(agent_ids: List[str]) -> Set[str]:
+    known = set()
+    missing = []
+    for agent_id in dict.fromkeys(agent_ids):
+        cached = agent_identity_cache.get(agent_id)
+        if cached is None:
+            missing.append(agent_id)
+        elif cached:
+            known.add(agent_id)
     
+    if missing:
+        found = await run_db(_known_agents, missing)
+        for agent_id in missing:
+            agent_identity_cache.put(agent_id, agent_id in found)
+        known |= found
+    return known
+
+async def publish_agent_identity(op: str, agent_ids: List[str]):
+    # "added" clears negative entries, "deleted" clears positive ones; every
+    # worker (including this one) applies the message from the channel.
+    await get_async_redis().publish(AGENT_IDENTITY_CHANNEL, json.dumps({"op": op, "ids": agent_ids}))
+
+async def agent_identity_listener():
+    # The first subscription keeps what lifespan warmed at startup
+    reconnecting = False
+    while True:
+        pubsub = get_async_redis().pubsub()
+        try:
+            await pubsub.subscribe(AGENT_IDENTITY_CHANNEL)
+            if reconnecting:
+                # Messages may have been missed while disconnected
+                agent_identity_cache.clear()
+                await warm_agent_identity_cache()
+            reconnecting = True
+            async for message in pubsub.listen():
+                if message["type"] != "message":
+                    continue
+                event = json.loads(message["data"])
+                agent_identity_cache.discard(event["ids"])
+                if event["op"] == "added":
+                    for agent_id in event["ids"]:
+                        agent_identity_cache.put(agent_id, True)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Agent identity listener error: {e}")
+            await asyncio.sleep(1)
+        finally:
+            await pubsub.reset()
+
+# Heartbeats land in Redis only. HEARTBEATS_KEY is the liveness index
+# (agent id -> last heartbeat unix time); HEARTBEATS_PENDING_KEY collects
+# what the flusher has not yet written to Postgres.
+HEARTBEATS_KEY = "agents:heartbeats"
+HEARTBEATS_PENDING_KEY = "agents:heartbeats:pending"
+
+async def record_heartbeat(agent_id: str):
+    now = time.time()
+    async with get_async_redis().pipeline(transaction=False) as pipe:
+        pipe.zadd(HEARTBEATS_KEY, {agent_id: now})
+        pipe.hset(HEARTBEATS_PENDING_KEY, agent_id, now)
+        await pipe.execute()
+
+async def get_online_agents() -> Dict[str, float]:
+    """Agents whose last heartbeat is within AGENT_OFFLINE_AFTER, with its time."""
+    entries = await get_async_redis().zrangebyscore(
+        HEARTBEATS_KEY, time.time() - AGENT_OFFLINE_AFTER, "+inf", withscores=True
+    )
+    return dict(entries)
+
+def _write_heartbeats(conn, agent_ids: List[str], timestamps: List[float]) -> List[str]:
+    # api_token is UNIQUE on database_migration.sql schemas, so every
+    # auto-created agent gets a token of its own
+    tokens = [uuid.uuid4().hex for _ in agent_ids]
+    cursor = conn.cursor()
     cursor.execute("""
+        INSERT INTO agents (id, name, location, api_token, status, last_heartbeat)
+        SELECT hb.id, hb.id, 'Unknown', hb.token, 'online', to_timestamp(hb.ts)::timestamp
+        FROM unnest(%s::varchar[], %s::float8[], %s::varchar[]) AS hb(id, ts, token)
+        ON CONFLICT (id) DO UPDATE
+        SET status = 'online',
+            last_heartbeat = GREATEST(agents.last_heartbeat, EXCLUDED.last_heartbeat)
+        RETURNING id, (xmax = 0) AS inserted
+    """, (agent_ids, timestamps, tokens))
+    created = [row[0] for row in cursor.fetchall() if row[1]]
+    cursor.close()
+    return created
+
+async def flush_heartbeats() -> int:
+    r = get_async_redis()
+    async with r.pipeline(transaction=True) as pipe:
+        pipe.hgetall(HEARTBEATS_PENDING_KEY)
+        pipe.delete(HEARTBEATS_PENDING_KEY)
+        pending, _ = await pipe.execute()
+    
+    if not pending:
+        return 0
+    
+    agent_ids = list(pending)
+    timestamps = [float(pending[a]) for a in agent_ids]
+    try:
+        created = await run_db(_write_heartbeats, agent_ids, timestamps)
+    except Exception:
+        # Put the batch back unless a newer heartbeat already replaced it
+        async with r.pipeline(transaction=False) as pipe:
+            for agent_id, ts in zip(agent_ids, timestamps):
+                pipe.hsetnx(HEARTBEATS_PENDING_KEY, agent_id, ts)
+            await pipe.execute()
+        raise
+    
+    if created:
+        await publish_agent_identity("added", created)
+        # A registry snapshot rebuilt between the heartbeat and this insert
+        # is missing these agents, and the online set won't change again
+        await r.incr(AGENT_REGISTRY_VERSION_KEY)
+    await r.zremrangebyscore(HEARTBEATS_KEY, "-inf", time.time() - HEARTBEAT_RETENTION)
+    return len(agent_ids)
+
+async def heartbeat_flusher():
+    while True:
+        await asyncio.sleep(HEARTBEAT_FLUSH_INTERVAL)
+        try:
+            await flush_heartbeats()
+        except Exception as e:
+            print(f"Heartbeat flush error: {e}")
+
+# Versioned schema migrations. Applied in order by `python backend_main.py
+# migrate` (the container runs it before starting uvicorn); each version is
+# recorded in schema_migrations and never runs twice.
+MIGRATIONS = [
+    (1, "initial schema", """
         CREATE TABLE IF NOT EXISTS agents (
             id VARCHAR(36) PRIMARY KEY,
             name VARCHAR(255) NOT NULL,
@@ -70,9 +674,7 @@ async def lifespan(app: FastAPI):
             registered_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
             metadata JSONB
         );
-    """)
-    
-    cursor.execute("""
+        
         CREATE TABLE IF NOT EXISTS checks (
             id VARCHAR(36) PRIMARY KEY,
             target VARCHAR(500) NOT NULL,
@@ -82,9 +684,7 @@ async def lifespan(app: FastAPI):
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
             completed_at TIMESTAMP
         );
-    """)
-    
-    cursor.execute("""
+        
         CREATE TABLE IF NOT EXISTS check_results (
             id VARCHAR(36) PRIMARY KEY,
             check_id VARCHAR(36) NOT NULL REFERENCES checks(id) ON DELETE CASCADE,
@@ -96,12 +696,355 @@ async def lifespan(app: FastAPI):
             duration_ms INTEGER,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         );
+    """),
+    (2, "hot query indexes", """
+        -- Completion is tracked at ingestion time; the recount-per-insert
+        -- trigger from database_migration.sql is no longer needed.
+        DROP TRIGGER IF EXISTS trigger_update_check_status ON check_results;
+        
+        CREATE INDEX IF NOT EXISTS idx_check_results_check_created
+            ON check_results (check_id, created_at DESC);
+        CREATE INDEX IF NOT EXISTS idx_check_results_agent_id
+            ON check_results (agent_id);
+        CREATE INDEX IF NOT EXISTS idx_checks_created_id
+            ON checks (created_at DESC, id DESC)
+            INCLUDE (target, status, completed_at, check_types);
+        CREATE INDEX IF NOT EXISTS idx_agents_status_heartbeat
+            ON agents (status, last_heartbeat);
+        CREATE INDEX IF NOT EXISTS idx_agents_registered_at
+            ON agents (registered_at DESC);
+    """),
+    (3, "partition check_results by created_at", """
+        -- The existing table becomes the first partition, covering everything
+        -- up to the start of next month; monthly partitions follow.
+        DO $$
+        DECLARE
+            boundary TIMESTAMP := date_trunc('month', CURRENT_TIMESTAMP)::timestamp + INTERVAL '1 month';
+        BEGIN
+            UPDATE check_results SET created_at = CURRENT_TIMESTAMP WHERE created_at IS NULL;
+            
+            ALTER TABLE check_results RENAME TO check_results_legacy;
+            ALTER TABLE check_results_legacy ALTER COLUMN created_at SET NOT NULL;
+            ALTER TABLE check_results_legacy DROP CONSTRAINT check_results_pkey;
+            ALTER TABLE check_results_legacy ADD PRIMARY KEY (id, created_at);
+            
+            CREATE TABLE check_results (
+                id VARCHAR(36) NOT NULL,
+                check_id VARCHAR(36) NOT NULL REFERENCES checks(id) ON DELETE CASCADE,
+                agent_id VARCHAR(36) NOT NULL REFERENCES agents(id) ON DELETE CASCADE,
+                check_type VARCHAR(50) NOT NULL,
+                success BOOLEAN NOT NULL,
+                data JSONB,
+                error TEXT,
+                duration_ms INTEGER,
+                created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (id, created_at)
+            ) PARTITION BY RANGE (created_at);
+            
+            EXECUTE format(
+                'ALTER TABLE check_results ATTACH PARTITION check_results_legacy FOR VALUES FROM (MINVALUE) TO (%L)',
+                boundary
+            );
+            
+            CREATE INDEX idx_check_results_p_check_created ON check_results (check_id, created_at DESC);
+            CREATE INDEX idx_check_results_p_agent_id ON check_results (agent_id);
+        END $$;
+        
+        CREATE OR REPLACE FUNCTION ensure_check_results_partitions(months_ahead INTEGER) RETURNS INTEGER AS $$
+        DECLARE
+            month_start TIMESTAMP;
+            partition_name TEXT;
+            created_count INTEGER := 0;
+        BEGIN
+            FOR i IN 0..months_ahead LOOP
+                month_start := date_trunc('month', CURRENT_TIMESTAMP)::timestamp + make_interval(months => i);
+                partition_name := 'check_results_' || to_char(month_start, 'YYYY_MM');
+                CONTINUE WHEN to_regclass(partition_name) IS NOT NULL;
+                BEGIN
+                    EXECUTE format(
+                        'CREATE TABLE %I PARTITION OF check_results FOR VALUES FROM (%L) TO (%L)',
+                        partition_name,
+                        month_start,
+                        month_start + INTERVAL '1 month'
+                    );
+                    created_count := created_count + 1;
+                EXCEPTION WHEN invalid_object_definition THEN
+                    -- Range is already covered (e.g. by check_results_legacy)
+                    NULL;
+                END;
+            END LOOP;
+            RETURN created_count;
+        END;
+        $$ LANGUAGE plpgsql;
+        
+        CREATE OR REPLACE FUNCTION drop_expired_check_results_partitions(retention_days INTEGER) RETURNS INTEGER AS $$
+        DECLARE
+            part RECORD;
+            upper_bound TIMESTAMP;
+            dropped_count INTEGER := 0;
+        BEGIN
+            FOR part IN
+                SELECT c.oid::regclass AS name, pg_get_expr(c.relpartbound, c.oid) AS bound
+                FROM pg_inherits i
+                JOIN pg_class c ON c.oid = i.inhrelid
+                WHERE i.inhparent = 'check_results'::regclass
+            LOOP
+                upper_bound := substring(part.bound FROM 'TO \\(''([^'']+)''\\)')::timestamp;
+                IF upper_bound IS NOT NULL AND upper_bound < CURRENT_TIMESTAMP - make_interval(days => retention_days) THEN
+                    EXECUTE format('DROP TABLE %s', part.name);
+                    dropped_count := dropped_count + 1;
+                END IF;
+            END LOOP;
+            RETURN dropped_count;
+        END;
+        $$ LANGUAGE plpgsql;
+    """),
+    (4, "recurring check schedules", """
+        CREATE TABLE IF NOT EXISTS check_schedules (
+            id VARCHAR(36) PRIMARY KEY,
+            target VARCHAR(500) NOT NULL,
+            check_types JSONB NOT NULL,
+            agent_ids JSONB,
+            interval_seconds INTEGER NOT NULL CHECK (interval_seconds > 0),
+            jitter_seconds INTEGER NOT NULL DEFAULT 0,
+            enabled BOOLEAN NOT NULL DEFAULT TRUE,
+            next_run_at TIMESTAMP NOT NULL,
+            last_run_at TIMESTAMP,
+            last_check_id VARCHAR(36),
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        );
+        
+        CREATE INDEX IF NOT EXISTS idx_check_schedules_updated_at ON check_schedules (updated_at);
+    """),
+    (5, "latency rollups", """
+        CREATE TABLE IF NOT EXISTS check_result_rollups (
+            granularity VARCHAR(10) NOT NULL,
+            bucket_start TIMESTAMP NOT NULL,
+            target VARCHAR(500) NOT NULL,
+            check_type VARCHAR(50) NOT NULL,
+            agent_id VARCHAR(36) NOT NULL,
+            location VARCHAR(255) NOT NULL,
+            total_count BIGINT NOT NULL,
+            success_count BIGINT NOT NULL,
+            min_ms INTEGER,
+            max_ms INTEGER,
+            sum_ms BIGINT NOT NULL DEFAULT 0,
+            histogram BIGINT[] NOT NULL,
+            PRIMARY KEY (granularity, target, check_type, agent_id, bucket_start)
+        );
+        
+        CREATE INDEX IF NOT EXISTS idx_check_result_rollups_location
+            ON check_result_rollups (granularity, target, check_type, location, bucket_start);
+        
+        -- Log-scale latency buckets: bucket i holds durations in
+        -- (1.2^(i-1), 1.2^i] ms, so percentiles read back from a merged
+        -- histogram stay within ~10% of the exact value.
+        CREATE OR REPLACE FUNCTION duration_bucket(ms INTEGER) RETURNS INTEGER AS $$
+            SELECT LEAST(79, CEIL(LN(GREATEST(ms, 1)) / LN(1.2))::INTEGER)
+        $$ LANGUAGE sql IMMUTABLE;
+        
+        CREATE OR REPLACE FUNCTION duration_histogram(buckets INTEGER[]) RETURNS BIGINT[] AS $$
+            SELECT ARRAY(
+                SELECT COUNT(b.bucket)
+                FROM generate_series(0, 79) AS g(i)
+                LEFT JOIN unnest(buckets) AS b(bucket) ON b.bucket = g.i
+                GROUP BY g.i
+                ORDER BY g.i
+            )
+        $$ LANGUAGE sql IMMUTABLE;
+        
+        CREATE OR REPLACE FUNCTION merge_histograms(a BIGINT[], b BIGINT[]) RETURNS BIGINT[] AS $$
+            SELECT ARRAY(
+                SELECT COALESCE(x, 0) + COALESCE(y, 0)
+                FROM unnest(a, b) WITH ORDINALITY AS t(x, y, n)
+                ORDER BY n
+            )
+        $$ LANGUAGE sql IMMUTABLE;
+        
+        DROP AGGREGATE IF EXISTS histogram_sum(BIGINT[]);
+        CREATE AGGREGATE histogram_sum(BIGINT[]) (
+            SFUNC = merge_histograms,
+            STYPE = BIGINT[],
+            INITCOND = '{}'
+        );
+        
+        -- Backfill from the raw rows once; ingestion keeps them current after this
+        INSERT INTO check_result_rollups AS r (
+            granularity, bucket_start, target, check_type, agent_id, location,
+            total_count, success_count, min_ms, max_ms, sum_ms, histogram
+        )
+        SELECT g.granularity, date_trunc(g.granularity, cr.created_at), c.target, cr.check_type,
+               cr.agent_id, a.location,
+               COUNT(*), COUNT(*) FILTER (WHERE cr.success),
+               MIN(cr.duration_ms) FILTER (WHERE cr.success),
+               MAX(cr.duration_ms) FILTER (WHERE cr.success),
+               COALESCE(SUM(cr.duration_ms) FILTER (WHERE cr.success), 0),
+               duration_histogram(array_agg(duration_bucket(cr.duration_ms)) FILTER (WHERE cr.success))
+        FROM check_results cr
+        JOIN checks c ON c.id = cr.check_id
+        JOIN agents a ON a.id = cr.agent_id
+        CROSS JOIN (VALUES ('minute'), ('hour')) AS g(granularity)
+        WHERE cr.created_at IS NOT NULL
+        GROUP BY 1, 2, 3, 4, 5, 6
+        ON CONFLICT DO NOTHING;
+    """),
+    (6, "in-progress checks index", """
+        -- Lets the task sweeper find checks stuck past their deadline
+        -- without scanning finished ones
+        CREATE INDEX IF NOT EXISTS idx_checks_in_progress_created
+            ON checks (created_at) WHERE status = 'in_progress';
+    """),
+    (7, "result dedupe index", """
+        -- _insert_results skips a result whose (check, agent, type) is
+        -- already stored; without this the probe scans the whole check
+        CREATE INDEX IF NOT EXISTS idx_check_results_p_task
+            ON check_results (check_id, agent_id, check_type);
+    """),
+    (8, "rebind legacy views to partitioned check_results", """
+        -- Views reference a table by OID, so the views from
+        -- database_migration.sql kept reading check_results_legacy after
+        -- migration 3 renamed it; recreate them, and its GIN index on result
+        -- data, against the partitioned table. Schemas built only from
+        -- MIGRATIONS have neither and are left alone.
+        DO $$
+        BEGIN
+            IF to_regclass('agent_stats') IS NOT NULL THEN
+                DROP VIEW agent_stats;
+                CREATE VIEW agent_stats AS
+                SELECT
+                    a.id,
+                    a.name,
+                    a.location,
+                    a.status,
+                    a.last_heartbeat,
+                    COUNT(DISTINCT cr.check_id) as total_checks_performed,
+                    COUNT(cr.id) as total_tasks_performed,
+                    AVG(cr.duration_ms) as avg_response_time_ms,
+                    SUM(CASE WHEN cr.success THEN 1 ELSE 0 END)::FLOAT / NULLIF(COUNT(cr.id), 0) * 100 as success_rate
+                FROM agents a
+                LEFT JOIN check_results cr ON a.id = cr.agent_id
+                GROUP BY a.id, a.name, a.location, a.status, a.last_heartbeat;
+            END IF;
+            
+            IF to_regclass('recent_checks_summary') IS NOT NULL THEN
+                DROP VIEW recent_checks_summary;
+                CREATE VIEW recent_checks_summary AS
+                SELECT
+                    c.id,
+                    c.target,
+                    c.status,
+                    c.created_at,
+                    c.completed_at,
+                    c.check_types,
+                    COUNT(cr.id) as results_count,
+                    SUM(CASE WHEN cr.success THEN 1 ELSE 0 END) as success_count,
+                    AVG(cr.duration_ms) as avg_duration_ms
+                FROM checks c
+                LEFT JOIN check_results cr ON c.id = cr.check_id
+                GROUP BY c.id, c.target, c.status, c.created_at, c.completed_at, c.check_types
+                ORDER BY c.created_at DESC
+                LIMIT 100;
+            END IF;
+            
+            -- The legacy partition's existing index is attached, not rebuilt
+            IF to_regclass('idx_check_results_data_gin') IS NOT NULL THEN
+                CREATE INDEX IF NOT EXISTS idx_check_results_p_data_gin ON check_results USING GIN (data);
+            END IF;
+        END $$;
+    """),
+]
+
+MIGRATIONS_LOCK_ID = 7420001
+PARTITION_MAINTENANCE_LOCK_ID = 7420002
+
+def _applied_migrations(cursor) -> Set[int]:
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name VARCHAR(255) NOT NULL,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
     """)
+    cursor.execute("SELECT version FROM schema_migrations")
+    return {row[0] for row in cursor.fetchall()}
+
+def run_migrations(conn) -> List[int]:
+    cursor = conn.cursor()
+    # Serializes concurrent deploys; released when get_db() commits
+    cursor.execute("SELECT pg_advisory_xact_lock(%s)", (MIGRATIONS_LOCK_ID,))
+    applied = _applied_migrations(cursor)
+    
+    newly_applied = []
+    for version, name, sql in MIGRATIONS:
+        if version in applied:
+            continue
+        print(f"⏳ Applying migration {version}: {name}")
+        cursor.execute(sql)
+        cursor.execute("INSERT INTO schema_migrations (version, name) VALUES (%s, %s)", (version, name))
+        newly_applied.append(version)
     
-    conn.commit()
     cursor.close()
+    maintain_partitions(conn)
+    return newly_applied
+
+def pending_migrations(conn) -> List[int]:
+    cursor = conn.cursor()
+    applied = _applied_migrations(cursor)
+    cursor.close()
+    return [version for version, _, _ in MIGRATIONS if version not in applied]
+
+def maintain_partitions(conn):
+    cursor = conn.cursor()
+    cursor.execute("SELECT pg_try_advisory_xact_lock(%s)", (PARTITION_MAINTENANCE_LOCK_ID,))
+    if not cursor.fetchone()[0]:
+        cursor.close()
+        return
+    cursor.execute("SELECT ensure_check_results_partitions(%s)", (PARTITION_MONTHS_AHEAD,))
+    if CHECK_RESULTS_RETENTION_DAYS > 0:
+        cursor.execute("SELECT drop_expired_check_results_partitions(%s)", (CHECK_RESULTS_RETENTION_DAYS,))
+        dropped = cursor.fetchone()[0]
+        if dropped:
+            print(f"🧹 Dropped {dropped} expired check_results partitions")
+    for granularity, days in (("minute", ROLLUP_MINUTE_RETENTION_DAYS), ("hour", ROLLUP_HOUR_RETENTION_DAYS)):
+        if days > 0:
+            cursor.execute("""
+                DELETE FROM check_result_rollups
+                WHERE granularity = %s AND bucket_start < CURRENT_TIMESTAMP - %s * INTERVAL '1 day'
+            """, (granularity, days))
+    cursor.close()
+
+async def partition_maintainer():
+    while True:
+        await asyncio.sleep(PARTITION_MAINTENANCE_INTERVAL)
+        try:
+            await run_db(maintain_partitions)
+        except Exception as e:
+            print(f"Partition maintenance error: {e}")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    print("🚀 Starting Host Checker Backend...")
     
-    print("✅ Database initialized")
+    if MIGRATE_ON_STARTUP:
+        await run_db(run_migrations)
+    else:
+        pending = await run_db(pending_migrations)
+        if pending:
+            print(f"⚠️  WARNING: Pending migrations {pending}. Run `python backend_main.py migrate`.")
+    await warm_agent_identity_cache()
+    check_updates_hub.start()
+    background_tasks = [
+        asyncio.create_task(agent_identity_listener()),
+        asyncio.create_task(heartbeat_flusher()),
+        asyncio.create_task(agent_liveness_sweeper()),
+        asyncio.create_task(partition_maintainer()),
+        asyncio.create_task(run_check_scheduler()),
+        asyncio.create_task(agent_load_refresher()),
+        asyncio.create_task(run_task_sweeper())
+    ]
+    
+    print(f"✅ Database connected (pool {DB_POOL_MIN_SIZE}-{DB_POOL_MAX_SIZE} connections)")
     print("✅ Redis connected")
     print("✅ CORS origins:", CORS_ORIGINS)
     print("✅ CORS credentials: False")
@@ -110,10 +1053,19 @@ async def lifespan(app: FastAPI):
     yield
     
     print("🛑 Shutting down...")
-    if db_conn:
-        db_conn.close()
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    try:
+        await flush_heartbeats()
+    except Exception as e:
+        print(f"Heartbeat flush error: {e}")
+    await check_updates_hub.stop()
+    close_db()
     if redis_client:
         redis_client.close()
+    if async_redis_client:
+        await async_redis_client.aclose()
 
 app = FastAPI(
     title="Host Checker API",
@@ -128,8 +1080,11 @@ app.add_middleware(
     allow_credentials=False,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag", "Link", "X-Next-Cursor"],
 )
 
+app.add_middleware(MetricsMiddleware)
+
 def validate_target(target: str) -> bool:
     if not target or len(target) > 500:
         return False
@@ -153,6 +1108,8 @@ class CreateCheckRequest(BaseModel):
     target: str = Field(..., description="URL, IP или домен для проверки")
     checks: List[str] = Field(..., description="Типы проверок: http, ping, dns, tcp, traceroute")
     agents: Optional[List[str]] = Field(None, description="ID агентов (если None - все доступные)")
+    agents_per_location: Optional[int] = Field(None, description="Сколько наименее загруженных агентов взять из каждой локации (если None - все)")
+    spread_by: str = Field("location", description="Группировка для agents_per_location: location или region")
 
 class Check(BaseModel):
     id: str
@@ -163,6 +1120,9 @@ class Check(BaseModel):
     completed_at: Optional[str] = None
     results: Optional[List[Dict]] = None
 
+class CreatedCheck(Check):
+    shared: bool = Field(False, description="Проверка объединена с уже идущей или недавно завершённой")
+
 class CheckResult(BaseModel):
     id: str
     check_id: str
@@ -214,13 +1174,15 @@ async def health_check():
         "version": "1.0.0"
     }
 
+def _ping_db(conn):
+    cursor = conn.cursor()
+    cursor.execute("SELECT 1")
+    cursor.close()
+
 @app.get("/health")
 async def detailed_health():
     try:
-        conn = get_db()
-        cursor = conn.cursor()
-        cursor.execute("SELECT 1")
-        cursor.close()
+        await run_db(_ping_db)
         db_status = "healthy"
     except Exception as e:
         db_status = f"unhealthy: {str(e)}"
@@ -232,12 +1194,86 @@ async def detailed_health():
     except Exception as e:
         redis_status = f"unhealthy: {str(e)}"
     
+    pool = db_pool
     return {
         "database": db_status,
+        "database_pool": {
+            "min_size": DB_POOL_MIN_SIZE,
+            "max_size": DB_POOL_MAX_SIZE,
+            "idle": len(pool._pool) if pool else 0,
+            "in_use": len(pool._used) if pool else 0
+        },
         "redis": redis_status,
+        "agent_cache": {
+            "size": len(agent_identity_cache._entries),
+            "hits": agent_identity_cache.hits,
+            "misses": agent_identity_cache.misses
+        },
+        "check_cache": {
+            "entries": len(check_response_cache._entries),
+            "bytes": check_response_cache.size_bytes,
+            "local_hits": check_response_cache.local_hits,
+            "redis_hits": check_response_cache.redis_hits,
+            "misses": check_response_cache.misses
+        },
+        "scheduler": {
+            "leader": check_scheduler.is_leader,
+            "schedules": len(check_scheduler.schedules),
+            "emitted": check_scheduler.emitted
+        },
+        "agent_load": {
+            "agents": len(agent_load.depths),
+            "overloaded": sum(1 for d in agent_load.depths.values() if agent_load.overloaded(d)),
+            "queued_tasks": sum(agent_load.depths.values()),
+            "refreshed_at": datetime.fromtimestamp(agent_load.refreshed_at).isoformat() if agent_load.refreshed_at else None
+        },
+        "task_sweeper": {
+            "reassigned": task_sweeper.reassigned,
+            "timed_out": task_sweeper.timed_out,
+            "expired_checks": task_sweeper.expired_checks
+        },
+        "websocket_hub": {
+            "checks": len(check_updates_hub.subscribers),
+            "subscribers": sum(len(q) for q in check_updates_hub.subscribers.values()),
+            "dropped_messages": check_updates_hub.dropped_messages,
+            "disconnected_consumers": check_updates_hub.disconnected_consumers
+        },
         "overall": "healthy" if db_status == "healthy" and redis_status == "healthy" else "degraded"
     }
 
+@app.get("/metrics")
+async def metrics():
+    lines = []
+    for metric in (http_request_duration, db_query_duration, redis_command_duration,
+                   check_completion_duration, results_ingested):
+        lines.extend(metric.render())
+    
+    # Gauges are read from state other components already maintain, so a
+    # scrape costs no extra Redis or database calls
+    lines += ["# HELP agent_queue_depth Tasks queued per online agent (as of the last load refresh)",
+              "# TYPE agent_queue_depth gauge"]
+    for agent_id, depth in agent_load.depths.items():
+        lines.append(f"agent_queue_depth{_metric_labels(('agent_id',), (agent_id,))} {depth}")
+    
+    pool = db_pool
+    lines += ["# HELP db_pool_connections_in_use Pooled database connections checked out",
+              "# TYPE db_pool_connections_in_use gauge",
+              f"db_pool_connections_in_use {len(pool._used) if pool else 0}",
+              "# HELP websocket_subscribers Open WebSocket subscriptions in this worker",
+              "# TYPE websocket_subscribers gauge",
+              f"websocket_subscribers {sum(len(q) for q in check_updates_hub.subscribers.values())}"]
+    
+    return Response(content="\n".join(lines) + "\n", media_type="text/plain; version=0.0.4")
+
+def _insert_agent(conn, agent_id: str, request: RegisterAgentRequest, api_token: str):
+    cursor = conn.cursor()
+    cursor.execute("""
+        INSERT INTO agents (id, name, location, api_token, status, metadata)
+        VALUES (%s, %s, %s, %s, %s, %s)
+    """, (agent_id, request.name, request.location, api_token, "offline", 
+          json.dumps(request.metadata) if request.metadata else None))
+    cursor.close()
+
 @app.post("/api/agents/register")
 async def register_agent(
     request: RegisterAgentRequest,
@@ -249,17 +1285,11 @@ async def register_agent(
     agent_id = str(uuid.uuid4())
     api_token = str(uuid.uuid4()) + str(uuid.uuid4()).replace("-", "")
     
-    conn = get_db()
-    cursor = conn.cursor()
-    
-    cursor.execute("""
-        INSERT INTO agents (id, name, location, api_token, status, metadata)
-        VALUES (%s, %s, %s, %s, %s, %s)
-    """, (agent_id, request.name, request.location, api_token, "offline", 
-          json.dumps(request.metadata) if request.metadata else None))
-    
-    conn.commit()
-    cursor.close()
+    await run_db(_insert_agent, agent_id, request, api_token)
+    agent_identity_cache.put(agent_id, True)
+    await publish_agent_identity("added", [agent_id])
+    await get_async_redis().incr(AGENT_REGISTRY_VERSION_KEY)
+    agent_registry.invalidate()
     
     return {
         "agent_id": agent_id,
@@ -270,83 +1300,133 @@ async def register_agent(
 @app.post("/api/agents/heartbeat")
 async def agent_heartbeat(request: HeartbeatRequest):
     try:
-        conn = get_db()
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            UPDATE agents 
-            SET status = 'online', last_heartbeat = CURRENT_TIMESTAMP
-            WHERE id = %s
-            RETURNING id
-        """, (request.agent_id,))
-        
-        result = cursor.fetchone()
-        conn.commit()
-        cursor.close()
-        
-        if not result:
-            cursor = conn.cursor()
-            cursor.execute("""
-                INSERT INTO agents (id, name, location, api_token, status)
-                VALUES (%s, %s, %s, %s, %s)
-                ON CONFLICT (id) DO UPDATE SET status = 'online', last_heartbeat = CURRENT_TIMESTAMP
-            """, (request.agent_id, request.agent_id, "Unknown", "temp-token", "online"))
-            conn.commit()
-            cursor.close()
-        
+        await record_heartbeat(request.agent_id)
         return {"status": "ok", "timestamp": datetime.now().isoformat()}
         
     except Exception as e:
         print(f"Heartbeat error: {e}")
         return {"status": "ok", "timestamp": datetime.now().isoformat()}
 
-@app.get("/api/agents")
-async def list_agents() -> List[Agent]:
-    try:
-        conn = get_db()
-        cursor = conn.cursor()
-        
-        try:
-            cursor.execute("""
-                UPDATE agents 
-                SET status = 'offline'
-                WHERE last_heartbeat < NOW() - INTERVAL '60 seconds'
-            """)
-            conn.commit()
-        except Exception:
-            pass
-        
-        cursor.execute("""
-            SELECT id, name, location, status, 
-                   last_heartbeat, registered_at, metadata
-            FROM agents
-            ORDER BY registered_at DESC
-        """)
+AGENT_REGISTRY_VERSION_KEY = "agents:registry:version"
+
+def _fetch_agents(conn):
+    cursor = conn.cursor()
+    
+    cursor.execute("""
+        SELECT id, name, location, status, 
+               last_heartbeat, registered_at, metadata
+        FROM agents
+        ORDER BY registered_at DESC
+    """)
+    
+    rows = cursor.fetchall()
+    cursor.close()
+    return rows
+
+def _mark_agents_offline(conn, online_ids: List[str]):
+    cursor = conn.cursor()
+    cursor.execute("""
+        UPDATE agents
+        SET status = 'offline'
+        WHERE status = 'online' AND id <> ALL(%s)
+    """, (online_ids,))
+    cursor.close()
+
+class AgentRegistrySnapshot:
+    """Pre-serialized /api/agents body, rebuilt only when registrations or liveness change."""
+
+    def __init__(self):
+        self.online: Optional[Dict[str, float]] = None
+        self.registry_version: Optional[str] = None
+        self.generation = 0
+        self.body: Optional[bytes] = None
+        self.etag: Optional[str] = None
+        self._adapter = TypeAdapter(List[Agent])
+        self._lock = asyncio.Lock()
+
+    def invalidate(self):
+        self.generation += 1
+        self.body = None
+
+    async def sweep(self):
+        online = await get_online_agents()
+        registry_version = await get_async_redis().get(AGENT_REGISTRY_VERSION_KEY)
         
-        rows = cursor.fetchall()
-        cursor.close()
+        someone_went_offline = self.online is None or any(a not in online for a in self.online)
+        if someone_went_offline:
+            await run_db(_mark_agents_offline, list(online))
         
-        agents = []
-        for row in rows:
-            agents.append(Agent(
-                id=row[0],
-                name=row[1],
-                location=row[2],
-                status=row[3],
-                last_heartbeat=row[4].isoformat() if row[4] else None,
-                registered_at=row[5].isoformat() if row[5] else datetime.now().isoformat(),
-                metadata=json.loads(row[6]) if row[6] else None
-            ))
-        
-        return agents
+        changed = (self.online is None or online.keys() != self.online.keys()
+                   or registry_version != self.registry_version)
+        self.online = online
+        self.registry_version = registry_version
+        if changed:
+            self.invalidate()
+
+    async def get(self):
+        if self.body is not None:
+            return self.body, self.etag
         
+        async with self._lock:
+            if self.body is None:
+                if self.online is None:
+                    await self.sweep()
+                generation = self.generation
+                online = self.online
+                rows = await run_db(_fetch_agents)
+                
+                agents = []
+                for row in rows:
+                    heartbeat = online.get(row[0])
+                    agents.append(Agent(
+                        id=row[0],
+                        name=row[1],
+                        location=row[2],
+                        status="online" if heartbeat is not None else "offline",
+                        last_heartbeat=datetime.fromtimestamp(heartbeat).isoformat() if heartbeat is not None
+                                       else (row[4].isoformat() if row[4] else None),
+                        registered_at=row[5].isoformat() if row[5] else datetime.now().isoformat(),
+                        metadata=row[6]
+                    ))
+                
+                body = self._adapter.dump_json(agents)
+                etag = f'"{hashlib.sha1(body).hexdigest()}"'
+                if generation != self.generation:
+                    # Invalidated while rebuilding: serve it, but don't keep it
+                    return body, etag
+                self.body, self.etag = body, etag
+            return self.body, self.etag
+
+agent_registry = AgentRegistrySnapshot()
+
+async def agent_liveness_sweeper():
+    while True:
+        try:
+            await agent_registry.sweep()
+        except Exception as e:
+            print(f"Agent liveness sweep error: {e}")
+        await asyncio.sleep(AGENT_SWEEP_INTERVAL)
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    tags = [t.strip().removeprefix("W/") for t in if_none_match.split(",")]
+    return "*" in tags or etag in tags
+
+@app.get("/api/agents", response_model=List[Agent])
+async def list_agents(if_none_match: Optional[str] = Header(None)):
+    try:
+        body, etag = await agent_registry.get()
     except Exception as e:
         print(f"Error in list_agents: {e}")
         return []
+    
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
 
-@app.get("/api/agents/{agent_id}")
-async def get_agent(agent_id: str) -> Agent:
-    conn = get_db()
+def _fetch_agent(conn, agent_id: str):
     cursor = conn.cursor(cursor_factory=RealDictCursor)
     
     cursor.execute("""
@@ -358,173 +1438,924 @@ async def get_agent(agent_id: str) -> Agent:
     
     agent = cursor.fetchone()
     cursor.close()
+    return agent
+
+@app.get("/api/agents/{agent_id}")
+async def get_agent(agent_id: str) -> Agent:
+    agent = await run_db(_fetch_agent, agent_id)
     
     if not agent:
         raise HTTPException(status_code=404, detail="Agent not found")
     
+    heartbeat = await get_async_redis().zscore(HEARTBEATS_KEY, agent_id)
+    if heartbeat is not None:
+        agent["last_heartbeat"] = datetime.fromtimestamp(heartbeat)
+    online = heartbeat is not None and heartbeat >= time.time() - AGENT_OFFLINE_AFTER
+    
     return Agent(
         id=agent["id"],
         name=agent["name"],
         location=agent["location"],
-        status=agent["status"],
+        status="online" if online else "offline",
         last_heartbeat=agent["last_heartbeat"].isoformat() if agent["last_heartbeat"] else None,
         registered_at=agent["registered_at"].isoformat(),
         metadata=agent["metadata"]
     )
 
-@app.post("/api/checks")
-async def create_check(request: CreateCheckRequest) -> Check:
-    if not validate_target(request.target):
-        raise HTTPException(status_code=400, detail="Invalid target format")
-    
-    if not validate_check_types(request.checks):
-        raise HTTPException(status_code=400, detail="Invalid check types")
+def _delete_agent(conn, agent_id: str) -> bool:
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM agents WHERE id = %s RETURNING id", (agent_id,))
+    deleted = cursor.fetchone() is not None
+    cursor.close()
+    return deleted
+
+@app.delete("/api/agents/{agent_id}")
+async def delete_agent(agent_id: str, x_registration_token: Optional[str] = Header(None)):
+    if x_registration_token != MASTER_REGISTRATION_TOKEN:
+        raise HTTPException(status_code=403, detail="Invalid registration token")
     
-    check_id = str(uuid.uuid4())
+    if not await run_db(_delete_agent, agent_id):
+        raise HTTPException(status_code=404, detail="Agent not found")
     
-    conn = get_db()
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    agent_identity_cache.put(agent_id, False)
+    async with get_async_redis().pipeline(transaction=False) as pipe:
+        pipe.zrem(HEARTBEATS_KEY, agent_id)
+        pipe.hdel(HEARTBEATS_PENDING_KEY, agent_id)
+        pipe.delete(agent_queue_key(agent_id), agent_stream_key(agent_id), agent_inflight_key(agent_id))
+        pipe.incr(AGENT_REGISTRY_VERSION_KEY)
+        await pipe.execute()
+    await publish_agent_identity("deleted", [agent_id])
+    agent_registry.invalidate()
     
-    if request.agents:
-        cursor.execute("""
-            SELECT id, name, location FROM agents 
-            WHERE id = ANY(%s) AND status = 'online'
-        """, (request.agents,))
+    return {"status": "ok", "agent_id": agent_id, "message": "Agent deleted"}
+
+def agent_queue_key(agent_id: str) -> str:
+    return f"agent:{agent_id}:tasks"
+
+def agent_stream_key(agent_id: str) -> str:
+    return f"agent:{agent_id}:stream"
+
+def agent_inflight_key(agent_id: str) -> str:
+    # "<check_id>:<check_type>" -> stream entry ID of the delivered task
+    return f"agent:{agent_id}:inflight"
+
+TASK_STREAM_GROUP = "agents"  # also hard-coded in the stream scripts below
+
+def queue_depth(pipe, agent_id: str):
+    # For streams this includes delivered but unacknowledged tasks
+    if TASK_QUEUE_BACKEND == "stream":
+        pipe.xlen(agent_stream_key(agent_id))
     else:
-        cursor.execute("""
-            SELECT id, name, location FROM agents 
-            WHERE status = 'online'
-        """)
+        pipe.llen(agent_queue_key(agent_id))
+
+def check_payload_key(check_id: str) -> str:
+    return f"check:{check_id}:payload"
+
+def check_remaining_key(check_id: str) -> str:
+    return f"check:{check_id}:remaining"
+
+def check_reassigned_key(check_id: str) -> str:
+    # Agents the sweeper moved some of this check's tasks to
+    return f"check:{check_id}:reassigned"
+
+TASKS_DEAD_LETTER_KEY = "tasks:dead"
+
+# Pushes task refs onto an agent queue and enforces TASK_QUEUE_MAX_LENGTH.
+# Whatever the drop policy pushes out goes to the dead-letter list as
+# "<reason>|<agent_id>|<ref>" for the task sweeper to reassign or time out.
+# ARGV: agent id, max length (0 = unbounded), drop policy, refs...
+ENQUEUE_TASKS_SCRIPT = """
+local max = tonumber(ARGV[2])
+local refs = {unpack(ARGV, 4)}
+local dropped = {}
+if max > 0 and ARGV[3] == 'drop_newest' then
+    local room = max - redis.call('LLEN', KEYS[1])
+    local accepted = {}
+    for i, ref in ipairs(refs) do
+        if i <= room then table.insert(accepted, ref) else table.insert(dropped, ref) end
+    end
+    refs = accepted
+end
+if #refs > 0 then
+    redis.call('LPUSH', KEYS[1], unpack(refs))
+end
+if max > 0 and ARGV[3] ~= 'drop_newest' then
+    local overflow = redis.call('LLEN', KEYS[1]) - max
+    if overflow > 0 then
+        dropped = redis.call('RPOP', KEYS[1], overflow)
+    end
+end
+for _, ref in ipairs(dropped) do
+    redis.call('LPUSH', KEYS[2], 'dropped|' .. ARGV[1] .. '|' .. ref)
+end
+return #dropped
+"""
+
+# Moves an offline agent's whole queue to the dead-letter list
+TAKE_QUEUE_SCRIPT = """
+local refs = redis.call('LRANGE', KEYS[1], 0, -1)
+redis.call('DEL', KEYS[1])
+for _, ref in ipairs(refs) do
+    redis.call('LPUSH', KEYS[2], 'orphaned|' .. ARGV[1] .. '|' .. ref)
+end
+return #refs
+"""
+
+# Stream counterparts of the list scripts. Each agent has its own stream
+# with a single consumer group, so the group's pending entries list is the
+# agent's set of delivered but unacknowledged tasks. Acknowledged entries
+# are deleted, which keeps XLEN equal to queued plus in-flight tasks.
+ENQUEUE_STREAM_SCRIPT = """
+redis.pcall('XGROUP', 'CREATE', KEYS[1], 'agents', '0', 'MKSTREAM')
+local max = tonumber(ARGV[2])
+local refs = {unpack(ARGV, 4)}
+local dropped = {}
+if max > 0 and ARGV[3] == 'drop_newest' then
+    local room = max - redis.call('XLEN', KEYS[1])
+    local accepted = {}
+    for i, ref in ipairs(refs) do
+        if i <= room then table.insert(accepted, ref) else table.insert(dropped, ref) end
+    end
+    refs = accepted
+end
+for _, ref in ipairs(refs) do
+    redis.call('XADD', KEYS[1], '*', 'ref', ref)
+end
+if max > 0 and ARGV[3] ~= 'drop_newest' then
+    local overflow = redis.call('XLEN', KEYS[1]) - max
+    if overflow > 0 then
+        for _, entry in ipairs(redis.call('XRANGE', KEYS[1], '-', '+', 'COUNT', overflow)) do
+            redis.call('XDEL', KEYS[1], entry[1])
+            table.insert(dropped, entry[2][2])
+        end
+    end
+end
+for _, ref in ipairs(dropped) do
+    redis.call('LPUSH', KEYS[2], 'dropped|' .. ARGV[1] .. '|' .. ref)
+end
+return #dropped
+"""
+
+# Redelivers entries left pending longer than ARGV[3] ms (the agent crashed
+# or restarted mid-probe), then tops up with new entries, in one round trip.
+# ARGV: consumer (agent id), count, min idle ms
+POP_STREAM_SCRIPT = """
+redis.pcall('XGROUP', 'CREATE', KEYS[1], 'agents', '0', 'MKSTREAM')
+local count = tonumber(ARGV[2])
+local entries = {}
+local claimed = redis.call('XAUTOCLAIM', KEYS[1], 'agents', ARGV[1], ARGV[3], '0-0', 'COUNT', count)
+for _, entry in ipairs(claimed[2]) do
+    if entry[2] then table.insert(entries, entry) end
+end
+if #entries < count then
+    local fresh = redis.call('XREADGROUP', 'GROUP', 'agents', ARGV[1], 'COUNT', count - #entries, 'STREAMS', KEYS[1], '>')
+    if fresh then
+        for _, entry in ipairs(fresh[1][2]) do table.insert(entries, entry) end
+    end
+end
+local refs = {}
+for _, entry in ipairs(entries) do
+    local ref = entry[2][2]
+    redis.call('HSET', KEYS[2], string.match(ref, '^[^:]+:[^:]+'), entry[1])
+    table.insert(refs, ref)
+end
+return refs
+"""
+
+# ARGV: "<check_id>:<check_type>" of each task to acknowledge
+ACK_STREAM_SCRIPT = """
+local acked = 0
+for _, field in ipairs(ARGV) do
+    local id = redis.call('HGET', KEYS[2], field)
+    if id then
+        acked = acked + redis.call('XACK', KEYS[1], 'agents', id)
+        redis.call('XDEL', KEYS[1], id)
+        redis.call('HDEL', KEYS[2], field)
+    end
+end
+return acked
+"""
+
+TAKE_STREAM_SCRIPT = """
+local entries = redis.call('XRANGE', KEYS[1], '-', '+')
+redis.call('DEL', KEYS[1], KEYS[3])
+for _, entry in ipairs(entries) do
+    redis.call('LPUSH', KEYS[2], 'orphaned|' .. ARGV[1] .. '|' .. entry[2][2])
+end
+return #entries
+"""
+
+def push_agent_tasks(pipe, agent_id: str, task_refs: List[str]):
+    if TASK_QUEUE_BACKEND == "stream":
+        pipe.eval(ENQUEUE_STREAM_SCRIPT, 2, agent_stream_key(agent_id), TASKS_DEAD_LETTER_KEY,
+                  agent_id, TASK_QUEUE_MAX_LENGTH, TASK_QUEUE_DROP_POLICY, *task_refs)
+    else:
+        pipe.eval(ENQUEUE_TASKS_SCRIPT, 2, agent_queue_key(agent_id), TASKS_DEAD_LETTER_KEY,
+                  agent_id, TASK_QUEUE_MAX_LENGTH, TASK_QUEUE_DROP_POLICY, *task_refs)
+
+def take_agent_queue(r, agent_id: str):
+    if TASK_QUEUE_BACKEND == "stream":
+        return r.eval(TAKE_STREAM_SCRIPT, 3, agent_stream_key(agent_id), TASKS_DEAD_LETTER_KEY,
+                      agent_inflight_key(agent_id), agent_id)
+    return r.eval(TAKE_QUEUE_SCRIPT, 2, agent_queue_key(agent_id), TASKS_DEAD_LETTER_KEY, agent_id)
+
+async def acknowledge_tasks(agent_id: str, task_keys: List[str]):
+    if TASK_QUEUE_BACKEND == "stream" and task_keys:
+        await get_async_redis().eval(ACK_STREAM_SCRIPT, 2, agent_stream_key(agent_id),
+                                     agent_inflight_key(agent_id), *task_keys)
+
+async def acknowledge_results(rows: List[tuple]):
+    if TASK_QUEUE_BACKEND != "stream":
+        return
+    by_agent: Dict[str, List[str]] = {}
+    for row in rows:
+        by_agent.setdefault(row[2], []).append(f"{row[1]}:{row[3]}")
+    async with get_async_redis().pipeline(transaction=False) as pipe:
+        for agent_id, task_keys in by_agent.items():
+            pipe.eval(ACK_STREAM_SCRIPT, 2, agent_stream_key(agent_id), agent_inflight_key(agent_id), *task_keys)
+        await pipe.execute()
+
+async def pop_stream_tasks(agent_id: str, limit: int, wait: float) -> List[Dict]:
+    r = get_async_redis()
+    refs = await r.eval(POP_STREAM_SCRIPT, 2, agent_stream_key(agent_id), agent_inflight_key(agent_id),
+                        agent_id, limit, TASK_CLAIM_TIMEOUT * 1000)
+    if not refs and wait > 0:
+        # Scripts can't block, so the long poll is a plain XREADGROUP
+        reply = await r.xreadgroup(TASK_STREAM_GROUP, agent_id, {agent_stream_key(agent_id): ">"},
+                                   count=limit, block=int(wait * 1000))
+        entries = reply[0][1] if reply else []
+        if entries:
+            refs = [fields["ref"] for _, fields in entries]
+            await r.hset(agent_inflight_key(agent_id), mapping={
+                task_key(ref): entry_id for (entry_id, _), ref in zip(entries, refs)
+            })
     
-    agents = cursor.fetchall()
+    tasks = await resolve_agent_tasks(agent_id, refs)
+    # Expired or payload-less entries won't be reported on; settle them now
+    delivered = {f"{t['check_id']}:{t['check_type']}" for t in tasks}
+    stale = [task_key(ref) for ref in refs if task_key(ref) not in delivered]
+    await acknowledge_tasks(agent_id, stale)
+    return tasks
+
+def parse_task_ref(ref: str) -> Tuple[str, str, Optional[float]]:
+    """Splits "<check_id>:<check_type>[:<deadline>]" into its parts."""
+    parts = ref.split(":")
+    deadline = float(parts[2]) if len(parts) > 2 else None
+    return parts[0], parts[1], deadline
+
+def task_key(ref: str) -> str:
+    """A ref without its deadline: "<check_id>:<check_type>"."""
+    return ":".join(ref.split(":")[:2])
+
+def queue_check_tasks(pipe, check_id: str, target: str, check_types: List[str], agent_ids: List[str]):
+    # The check payload is stored once; agent queues only hold
+    # "<check_id>:<check_type>:<deadline>" references. The payload is queued
+    # on the pipeline before any reference to it.
+    suffix = f":{int(time.time()) + TASK_DEADLINE}" if TASK_DEADLINE > 0 else ""
+    task_refs = [f"{check_id}:{check_type}{suffix}" for check_type in check_types]
+    payload = json.dumps({"target": target, "check_types": check_types})
     
-    if not agents:
-        raise HTTPException(status_code=400, detail="No online agents available")
+    pipe.set(check_payload_key(check_id), payload, ex=TASK_PAYLOAD_TTL)
+    pipe.set(check_remaining_key(check_id), len(task_refs) * len(agent_ids), ex=CHECK_COUNTER_TTL)
+    for agent_id in agent_ids:
+        push_agent_tasks(pipe, agent_id, task_refs)
+
+async def enqueue_check_tasks(check_id: str, target: str, check_types: List[str], agent_ids: List[str]):
+    async with get_async_redis().pipeline(transaction=False) as pipe:
+        queue_check_tasks(pipe, check_id, target, check_types, agent_ids)
+        await pipe.execute()
+
+async def resolve_agent_tasks(agent_id: str, entries: List[str]) -> List[Dict]:
+    refs = []
+    tasks = []
+    expired = []
+    now = time.time()
+    for entry in entries:
+        if entry.startswith("{"):
+            # Full task document queued before references were introduced
+            tasks.append(json.loads(entry))
+            continue
+        check_id, check_type, deadline = parse_task_ref(entry)
+        if deadline is not None and deadline < now:
+            expired.append(f"expired|{agent_id}|{entry}")
+            continue
+        refs.append((check_id, check_type))
+    
+    if expired:
+        # Not worth probing any more; the sweeper records them as timed out
+        await get_async_redis().lpush(TASKS_DEAD_LETTER_KEY, *expired)
+    
+    if not refs:
+        return tasks
+    
+    check_ids = list(dict.fromkeys(check_id for check_id, _ in refs))
+    payloads = await get_async_redis().mget([check_payload_key(c) for c in check_ids])
+    targets = {
+        check_id: json.loads(payload)["target"]
+        for check_id, payload in zip(check_ids, payloads)
+        if payload is not None
+    }
+    
+    for check_id, check_type in refs:
+        if check_id not in targets:
+            continue
+        tasks.append({
+            "check_id": check_id,
+            "agent_id": agent_id,
+            "check_type": check_type,
+            "target": targets[check_id]
+        })
+    return tasks
+
+def agent_latency_key(minute: int) -> str:
+    return f"agents:latency:{minute}"
+
+def record_agent_latency(pipe, rows: List[tuple], latencies: Dict[str, int]):
+    # Per-minute sum/count of how long each agent took to answer, measured
+    # on the server from check creation to ingestion; agent-reported
+    # durations are missing for most probe types. The load view reads the
+    # last AGENT_LATENCY_WINDOW minutes of these.
+    key = agent_latency_key(int(time.time() // 60))
+    for row in rows:
+        if row[0] in latencies:
+            pipe.hincrby(key, f"{row[2]}:ms", max(int(latencies[row[0]]), 1))
+            pipe.hincrby(key, f"{row[2]}:n", 1)
+    pipe.expire(key, (AGENT_LATENCY_WINDOW + 1) * 60)
+
+def _fetch_agent_locations(conn, agent_ids: List[str]) -> Dict[str, str]:
+    cursor = conn.cursor()
+    cursor.execute("SELECT id, location FROM agents WHERE id = ANY(%s)", (agent_ids,))
+    locations = dict(cursor.fetchall())
+    cursor.close()
+    return locations
+
+def agent_region(location: str) -> str:
+    # Locations are registered as "Country, City"
+    return location.split(",", 1)[0].strip()
+
+class AgentLoadView:
+    """Queue depth and recent task latency of online agents, refreshed in the background."""
+
+    def __init__(self):
+        self.depths: Dict[str, int] = {}
+        self.latency_ms: Dict[str, float] = {}
+        self.locations: Dict[str, str] = {}
+        self.refreshed_at = 0.0
+
+    def overloaded(self, depth: int) -> bool:
+        return AGENT_MAX_BACKLOG > 0 and depth > AGENT_MAX_BACKLOG
+
+    async def refresh(self):
+        online = list(await get_online_agents())
+        minute = int(time.time() // 60)
+        async with get_async_redis().pipeline(transaction=False) as pipe:
+            for agent_id in online:
+                queue_depth(pipe, agent_id)
+            for offset in range(AGENT_LATENCY_WINDOW):
+                pipe.hgetall(agent_latency_key(minute - offset))
+            replies = await pipe.execute()
+        
+        totals: Dict[str, List[int]] = {}
+        for window in replies[len(online):]:
+            for field, value in window.items():
+                agent_id, kind = field.rsplit(":", 1)
+                total = totals.setdefault(agent_id, [0, 0])
+                total[0 if kind == "ms" else 1] += int(value)
+        
+        await self.ensure_locations(online)
+        self.depths = dict(zip(online, replies[:len(online)]))
+        self.latency_ms = {a: ms / n for a, (ms, n) in totals.items() if n}
+        self.refreshed_at = time.time()
+
+    def expected_wait(self, agent_id: str) -> float:
+        # Roughly how long a newly queued task waits: everything ahead of it
+        # plus itself, at this agent's recent pace
+        return (self.depths.get(agent_id, 0) + 1) * self.latency_ms.get(agent_id, AGENT_DEFAULT_TASK_MS)
+
+    async def ensure_locations(self, agent_ids: List[str]):
+        unknown = [a for a in agent_ids if a not in self.locations]
+        if unknown:
+            self.locations.update(await run_db(_fetch_agent_locations, unknown))
+
+    def replacement_for(self, agent_id: str, exclude: Set[str]) -> Optional[str]:
+        """Least loaded online agent in the same location, other than agent_id and exclude."""
+        location = self.locations.get(agent_id)
+        candidates = [
+            a for a, depth in self.depths.items()
+            if a != agent_id and a not in exclude and self.locations.get(a) == location
+            and not self.overloaded(depth)
+        ]
+        if location is None or not candidates:
+            return None
+        best = min(candidates, key=self.expected_wait)
+        self.depths[best] += 1
+        return best
+
+    def select(self, candidates: List[str], per_group: Optional[int] = None,
+               spread_by: str = "location", tasks_per_agent: int = 1) -> List[str]:
+        available = [a for a in candidates if not self.overloaded(self.depths.get(a, 0))]
+        
+        if per_group:
+            groups: Dict[str, List[str]] = {}
+            for agent_id in available:
+                location = self.locations.get(agent_id, "Unknown")
+                group = agent_region(location) if spread_by == "region" else location
+                groups.setdefault(group, []).append(agent_id)
+            # Random tie-break so equally idle agents share the work
+            selected = []
+            for members in groups.values():
+                members.sort(key=lambda a: (self.expected_wait(a), random.random()))
+                selected.extend(members[:per_group])
+        else:
+            selected = available
+        
+        # Account for the new tasks right away so a burst of checks between
+        # refreshes doesn't pile onto the same agents
+        for agent_id in selected:
+            self.depths[agent_id] = self.depths.get(agent_id, 0) + tasks_per_agent
+        return selected
+
+agent_load = AgentLoadView()
+
+async def agent_load_refresher():
+    while True:
+        try:
+            await agent_load.refresh()
+        except Exception as e:
+            print(f"Agent load refresh error: {e}")
+        await asyncio.sleep(AGENT_LOAD_REFRESH_INTERVAL)
+
+def _insert_check(conn, check_id: str, request: CreateCheckRequest, agent_ids: List[str]):
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
     
     cursor.execute("""
         INSERT INTO checks (id, target, check_types, agent_ids, status)
         VALUES (%s, %s, %s, %s, %s)
         RETURNING id, target, check_types, status, created_at
     """, (check_id, request.target, json.dumps(request.checks), 
-          json.dumps([a["id"] for a in agents]), "in_progress"))
+          json.dumps(agent_ids), "in_progress"))
     
     check = cursor.fetchone()
-    conn.commit()
-    
-    r = get_redis()
-    
-    for agent in agents:
-        for check_type in request.checks:
-            task_data = {
-                "check_id": check_id,
-                "agent_id": agent["id"],
-                "check_type": check_type,
-                "target": request.target
-            }
-            
-            r.lpush(f"agent:{agent['id']}:tasks", json.dumps(task_data))
-    
     cursor.close()
+    return check
+
+def coalesce_key(target: str, check_types: List[str], agent_ids: List[str]) -> str:
+    target = target.strip()
+    if "/" not in target:
+        target = target.lower()
+    normalized = json.dumps([target, sorted(set(check_types)), sorted(agent_ids)])
+    return f"coalesce:check:{hashlib.sha1(normalized.encode()).hexdigest()}"
+
+# Creations in progress in this worker, so simultaneous duplicates wait for
+# the first one instead of polling Redis.
+inflight_check_creations: Dict[str, asyncio.Future] = {}
+
+# Points a coalesce key at a check id before that check is created, so
+# duplicates on other workers attach to it instead of creating their own.
+# The key is taken when it is free or still names ARGV[3], a check the
+# caller found unusable. Returns nil once claimed, else the current owner.
+# ARGV: new check id, ttl, stale check id ('' for none)
+CLAIM_COALESCE_SCRIPT = """
+local current = redis.call('GET', KEYS[1])
+if current and current ~= ARGV[3] then
+    return current
+end
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+return false
+"""
+
+RELEASE_COALESCE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+def shared_check(check: Dict) -> Optional[CreatedCheck]:
+    now = datetime.now()
+    if check["status"] == "in_progress":
+        reusable = (now - check["created_at"]).total_seconds() <= TASK_PAYLOAD_TTL
+    else:
+        reusable = (check["status"] == "completed" and check["completed_at"] is not None
+                    and (now - check["completed_at"]).total_seconds() <= CHECK_COALESCE_WINDOW)
+    if not reusable:
+        return None
     
-    return Check(
+    return CreatedCheck(
         id=check["id"],
         target=check["target"],
-        check_types=json.loads(check["check_types"]),
+        check_types=check["check_types"],
+        status=check["status"],
+        created_at=check["created_at"].isoformat(),
+        completed_at=check["completed_at"].isoformat() if check["completed_at"] else None,
+        results=[],
+        shared=True
+    )
+
+async def claim_coalesce_key(key: str, check_id: str) -> Optional[CreatedCheck]:
+    """Claims key for check_id, or returns the shareable check another request already claimed it for."""
+    r = get_async_redis()
+    stale = ""
+    deadline = time.monotonic() + CHECK_COALESCE_CLAIM_WAIT
+    while True:
+        owner = await r.eval(CLAIM_COALESCE_SCRIPT, 1, key, check_id, TASK_PAYLOAD_TTL, stale)
+        if owner is None:
+            return None
+        check = await run_db(_fetch_check_row, owner)
+        if check is None and time.monotonic() < deadline:
+            # The owner is still inserting its check
+            await asyncio.sleep(0.05)
+            continue
+        shared = shared_check(check) if check else None
+        if shared is not None:
+            return shared
+        # Too old to share, or the owner never finished: take the key over
+        stale = owner
+
+def select_check_agents(request: CreateCheckRequest, online: Dict[str, float]) -> List[str]:
+    agent_ids = agent_load.select(list(online), request.agents_per_location,
+                                  request.spread_by, len(request.checks))
+    if not agent_ids:
+        raise HTTPException(status_code=503, detail="All online agents are overloaded")
+    return agent_ids
+
+@app.post("/api/checks")
+async def create_check(request: CreateCheckRequest) -> CreatedCheck:
+    if not validate_target(request.target):
+        raise HTTPException(status_code=400, detail="Invalid target format")
+    
+    if not validate_check_types(request.checks):
+        raise HTTPException(status_code=400, detail="Invalid check types")
+    
+    if request.agents_per_location is not None and request.agents_per_location < 1:
+        raise HTTPException(status_code=400, detail="agents_per_location must be positive")
+    
+    if request.spread_by not in ("location", "region"):
+        raise HTTPException(status_code=400, detail="spread_by must be location or region")
+    
+    online = await get_online_agents()
+    if request.agents:
+        # An explicit list is honoured as-is, backlog or not
+        agent_ids = [a for a in dict.fromkeys(request.agents) if a in online]
+        selection = agent_ids
+    else:
+        # Agents are picked only once the request is known not to join an
+        # existing check, so a coalesced request never books load or gets a
+        # 503 while a shareable check is there
+        agent_ids = None
+        selection = [f"auto:{request.agents_per_location or 'all'}:{request.spread_by}"]
+    
+    if not online or agent_ids == []:
+        raise HTTPException(status_code=400, detail="No online agents available")
+    
+    if CHECK_COALESCE_WINDOW <= 0:
+        return await start_check(request, agent_ids or select_check_agents(request, online))
+    
+    key = coalesce_key(request.target, request.checks, selection)
+    pending = inflight_check_creations.get(key)
+    if pending is not None:
+        created = await asyncio.shield(pending)
+        return created.model_copy(update={"shared": True})
+    
+    future = asyncio.get_running_loop().create_future()
+    inflight_check_creations[key] = future
+    check_id = str(uuid.uuid4())
+    claimed = False
+    created = None
+    try:
+        shared = await claim_coalesce_key(key, check_id)
+        if shared is not None:
+            future.set_result(shared)
+            return shared
+        claimed = True
+        created = await start_check(request, agent_ids or select_check_agents(request, online), check_id)
+        future.set_result(created)
+        return created
+    except Exception as e:
+        future.set_exception(e)
+        # Mark as retrieved when nobody else was waiting on it
+        future.exception()
+        raise
+    except BaseException:
+        future.cancel()
+        raise
+    finally:
+        del inflight_check_creations[key]
+        if claimed and created is None:
+            # Let the next request claim the key instead of waiting on a
+            # check that will never exist
+            await get_async_redis().eval(RELEASE_COALESCE_SCRIPT, 1, key, check_id)
+
+async def start_check(request: CreateCheckRequest, agent_ids: List[str],
+                      check_id: Optional[str] = None) -> CreatedCheck:
+    check_id = check_id or str(uuid.uuid4())
+    
+    check = await run_db(_insert_check, check_id, request, agent_ids)
+    
+    await enqueue_check_tasks(check_id, request.target, request.checks, agent_ids)
+    
+    return CreatedCheck(
+        id=check["id"],
+        target=check["target"],
+        check_types=request.checks,
         status=check["status"],
         created_at=check["created_at"].isoformat(),
         results=[]
     )
 
-@app.get("/api/checks/{check_id}")
-async def get_check(check_id: str) -> Check:
-    conn = get_db()
+def encode_page_cursor(created_at: datetime, row_id: str) -> str:
+    raw = json.dumps([created_at.isoformat(), row_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_page_cursor(cursor: str) -> Tuple[datetime, str]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        created_at, row_id = json.loads(raw)
+        return datetime.fromisoformat(created_at), str(row_id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def result_row_to_dict(r) -> Dict[str, Any]:
+    return {
+        "id": r["id"],
+        "check_id": r["check_id"],
+        "agent_id": r["agent_id"],
+        "agent_name": r["agent_name"],
+        "agent_location": r["agent_location"],
+        "check_type": r["check_type"],
+        "success": r["success"],
+        "data": r["data"],
+        "error": r["error"],
+        "duration_ms": r["duration_ms"],
+        "created_at": r["created_at"].isoformat()
+    }
+
+CHECK_RESULTS_QUERY = """
+    SELECT cr.id, cr.check_id, cr.agent_id, cr.check_type, 
+           cr.success, cr.data, cr.error, cr.duration_ms, cr.created_at,
+           a.name as agent_name, a.location as agent_location
+    FROM check_results cr
+    JOIN agents a ON cr.agent_id = a.id
+    WHERE cr.check_id = %s
+"""
+
+def _fetch_check_row(conn, check_id: str):
     cursor = conn.cursor(cursor_factory=RealDictCursor)
-    
     cursor.execute("""
         SELECT id, target, check_types, status, created_at, completed_at
         FROM checks
         WHERE id = %s
     """, (check_id,))
-    
     check = cursor.fetchone()
+    cursor.close()
+    return check
+
+def _fetch_check(conn, check_id: str):
+    check = _fetch_check_row(conn, check_id)
     
     if not check:
-        raise HTTPException(status_code=404, detail="Check not found")
-    
-    cursor.execute("""
-        SELECT cr.id, cr.check_id, cr.agent_id, cr.check_type, 
-               cr.success, cr.data, cr.error, cr.duration_ms, cr.created_at,
-               a.name as agent_name, a.location as agent_location
-        FROM check_results cr
-        JOIN agents a ON cr.agent_id = a.id
-        WHERE cr.check_id = %s
-        ORDER BY cr.created_at DESC
-    """, (check_id,))
+        return None, []
     
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    cursor.execute(CHECK_RESULTS_QUERY + " ORDER BY cr.created_at DESC", (check_id,))
     results = cursor.fetchall()
     cursor.close()
+    return check, results
+
+# Builds the exact get_check document inside Postgres, so large checks skip
+# per-row Python dicts, isoformat() calls and pydantic re-serialization.
+# Timestamps are formatted like datetime.isoformat(), which leaves out the
+# fraction when it is exactly zero.
+CHECK_DOCUMENT_QUERY = """
+    SELECT json_build_object(
+        'id', c.id,
+        'target', c.target,
+        'check_types', c.check_types,
+        'status', c.status,
+        'created_at', regexp_replace(to_char(c.created_at, 'YYYY-MM-DD"T"HH24:MI:SS.US'), '\\.000000$', ''),
+        'completed_at', regexp_replace(to_char(c.completed_at, 'YYYY-MM-DD"T"HH24:MI:SS.US'), '\\.000000$', ''),
+        'results', COALESCE((
+            SELECT json_agg(json_build_object(
+                'id', cr.id,
+                'check_id', cr.check_id,
+                'agent_id', cr.agent_id,
+                'agent_name', a.name,
+                'agent_location', a.location,
+                'check_type', cr.check_type,
+                'success', cr.success,
+                'data', cr.data,
+                'error', cr.error,
+                'duration_ms', cr.duration_ms,
+                'created_at', regexp_replace(to_char(cr.created_at, 'YYYY-MM-DD"T"HH24:MI:SS.US'), '\\.000000$', '')
+            ) ORDER BY cr.created_at DESC)
+            FROM check_results cr
+            JOIN agents a ON cr.agent_id = a.id
+            WHERE cr.check_id = c.id
+        ), '[]'::json)
+    )::text, c.status
+    FROM checks c
+    WHERE c.id = %s
+"""
+
+def _fetch_check_document(conn, check_id: str):
+    cursor = conn.cursor()
+    cursor.execute(CHECK_DOCUMENT_QUERY, (check_id,))
+    row = cursor.fetchone()
+    cursor.close()
+    return (row[0].encode(), row[1]) if row else (None, None)
+
+def check_response_key(check_id: str) -> str:
+    return f"check:{check_id}:response"
+
+class CheckResponseCache:
+    """Serialized get_check bodies.
+
+    Completed checks never change, so their bodies are kept in a bounded
+    in-process LRU and shared with other workers through Redis. In-progress
+    checks only get a short-lived local micro-cache entry.
+    """
+
+    def __init__(self, max_entries: int, max_bytes: int, ttl: int, micro_ttl: float):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.micro_ttl = micro_ttl
+        self.size_bytes = 0
+        self.local_hits = 0
+        self.redis_hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, Tuple[bytes, Optional[float]]]" = OrderedDict()
+
+    def _store(self, check_id: str, body: bytes, expires: Optional[float]):
+        self._evict(check_id)
+        self._entries[check_id] = (body, expires)
+        self.size_bytes += len(body)
+        while self._entries and (len(self._entries) > self.max_entries or self.size_bytes > self.max_bytes):
+            _, (old_body, _) = self._entries.popitem(last=False)
+            self.size_bytes -= len(old_body)
+
+    def _evict(self, check_id: str):
+        entry = self._entries.pop(check_id, None)
+        if entry is not None:
+            self.size_bytes -= len(entry[0])
+
+    async def get(self, check_id: str) -> Optional[bytes]:
+        entry = self._entries.get(check_id)
+        if entry is not None:
+            body, expires = entry
+            if expires is None or expires > time.monotonic():
+                self._entries.move_to_end(check_id)
+                self.local_hits += 1
+                return body
+            self._evict(check_id)
+        
+        body = await get_async_redis().get(check_response_key(check_id))
+        if body is not None:
+            body = body.encode()
+            self._store(check_id, body, None)
+            self.redis_hits += 1
+            return body
+        
+        self.misses += 1
+        return None
+
+    async def put(self, check_id: str, body: bytes, completed: bool):
+        if completed:
+            self._store(check_id, body, None)
+            await get_async_redis().set(check_response_key(check_id), body, ex=self.ttl)
+        elif self.micro_ttl > 0:
+            self._store(check_id, body, time.monotonic() + self.micro_ttl)
+
+check_response_cache = CheckResponseCache(
+    CHECK_CACHE_MAX_ENTRIES, CHECK_CACHE_MAX_BYTES, CHECK_CACHE_TTL, CHECK_MICRO_CACHE_TTL
+)
+
+@app.get("/api/checks/{check_id}", response_model=Check)
+async def get_check(check_id: str):
+    body = await check_response_cache.get(check_id)
+    if body is not None:
+        return Response(content=body, media_type="application/json")
     
-    check_types = json.loads(check["check_types"])
-    agent_ids = json.loads(check["agent_ids"] if check.get("agent_ids") else "[]")
-    expected_results = len(check_types) * len(agent_ids)
+    if CHECK_JSON_IN_DB:
+        body, status = await run_db(_fetch_check_document, check_id)
+    else:
+        body, status = await render_check(check_id)
     
-    if len(results) >= expected_results and check["status"] == "in_progress":
-        cursor = conn.cursor()
-        cursor.execute("""
-            UPDATE checks 
-            SET status = 'completed', completed_at = CURRENT_TIMESTAMP
-            WHERE id = %s
-        """, (check_id,))
-        conn.commit()
-        cursor.close()
-        check["status"] = "completed"
-        check["completed_at"] = datetime.now()
+    if body is None:
+        raise HTTPException(status_code=404, detail="Check not found")
+    
+    await check_response_cache.put(check_id, body, status == "completed")
+    return Response(content=body, media_type="application/json")
+
+async def render_check(check_id: str):
+    check, results = await run_db(_fetch_check, check_id)
     
-    return Check(
+    if not check:
+        return None, None
+    
+    body = Check(
         id=check["id"],
         target=check["target"],
-        check_types=json.loads(check["check_types"]),
+        check_types=check["check_types"],
         status=check["status"],
         created_at=check["created_at"].isoformat(),
         completed_at=check["completed_at"].isoformat() if check.get("completed_at") else None,
-        results=[
-            {
-                "id": r["id"],
-                "check_id": r["check_id"],
-                "agent_id": r["agent_id"],
-                "agent_name": r["agent_name"],
-                "agent_location": r["agent_location"],
-                "check_type": r["check_type"],
-                "success": r["success"],
-                "data": r["data"],
-                "error": r["error"],
-                "duration_ms": r["duration_ms"],
-                "created_at": r["created_at"].isoformat()
-            }
-            for r in results
-        ]
+        results=[result_row_to_dict(r) for r in results]
+    ).model_dump_json().encode()
+    return body, check["status"]
+
+def _fetch_check_results_page(conn, check_id: str, limit: int, after: Optional[Tuple[datetime, str]]):
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    if after:
+        cursor.execute(CHECK_RESULTS_QUERY + """
+              AND (cr.created_at, cr.id) < (%s, %s)
+            ORDER BY cr.created_at DESC, cr.id DESC
+            LIMIT %s
+        """, (check_id, after[0], after[1], limit + 1))
+    else:
+        cursor.execute(CHECK_RESULTS_QUERY + """
+            ORDER BY cr.created_at DESC, cr.id DESC
+            LIMIT %s
+        """, (check_id, limit + 1))
+    rows = cursor.fetchall()
+    cursor.close()
+    return rows
+
+@app.get("/api/checks/{check_id}/results")
+async def list_check_results(check_id: str, limit: int = 100, cursor: Optional[str] = None):
+    limit = max(1, min(limit, PAGE_MAX_LIMIT))
+    after = decode_page_cursor(cursor) if cursor else None
+    
+    rows = await run_db(_fetch_check_results_page, check_id, limit, after)
+    
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_page_cursor(rows[-1]["created_at"], rows[-1]["id"])
+    
+    return {
+        "results": [result_row_to_dict(r) for r in rows],
+        "next_cursor": next_cursor
+    }
+
+@app.get("/api/checks/{check_id}/results/export")
+async def export_check_results(check_id: str):
+    if not await run_db(_fetch_check_row, check_id):
+        raise HTTPException(status_code=404, detail="Check not found")
+    
+    async def ndjson_lines():
+        query = CHECK_RESULTS_QUERY + " ORDER BY cr.created_at DESC, cr.id DESC"
+        async for rows in stream_db(query, (check_id,), EXPORT_CHUNK_SIZE):
+            yield "".join(json.dumps(result_row_to_dict(r)) + "\n" for r in rows)
+    
+    return StreamingResponse(
+        ndjson_lines(),
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="check-{check_id}-results.ndjson"'}
     )
 
-@app.get("/api/checks")
-async def list_checks(limit: int = 50) -> List[Check]:
-    conn = get_db()
+def _fetch_checks(conn, limit: int, after: Optional[Tuple[datetime, str]]):
     cursor = conn.cursor(cursor_factory=RealDictCursor)
     
-    cursor.execute("""
-        SELECT id, target, check_types, status, created_at, completed_at
-        FROM checks
-        ORDER BY created_at DESC
-        LIMIT %s
-    """, (limit,))
+    if after:
+        cursor.execute("""
+            SELECT id, target, check_types, status, created_at, completed_at
+            FROM checks
+            WHERE (created_at, id) < (%s, %s)
+            ORDER BY created_at DESC, id DESC
+            LIMIT %s
+        """, (after[0], after[1], limit + 1))
+    else:
+        cursor.execute("""
+            SELECT id, target, check_types, status, created_at, completed_at
+            FROM checks
+            ORDER BY created_at DESC, id DESC
+            LIMIT %s
+        """, (limit + 1,))
     
     checks = cursor.fetchall()
     cursor.close()
+    return checks
+
+@app.get("/api/checks", response_model=List[Check])
+async def list_checks(response: Response, limit: int = 50, cursor: Optional[str] = None):
+    limit = max(1, min(limit, PAGE_MAX_LIMIT))
+    after = decode_page_cursor(cursor) if cursor else None
+    
+    checks = await run_db(_fetch_checks, limit, after)
+    
+    # The body stays a plain list; the next page is advertised in headers
+    if len(checks) > limit:
+        checks = checks[:limit]
+        next_cursor = encode_page_cursor(checks[-1]["created_at"], checks[-1]["id"])
+        response.headers["X-Next-Cursor"] = next_cursor
+        response.headers["Link"] = f'</api/checks?limit={limit}&cursor={next_cursor}>; rel="next"'
     
     return [
         Check(
             id=c["id"],
             target=c["target"],
-            check_types=json.loads(c["check_types"]),
+            check_types=c["check_types"],
             status=c["status"],
             created_at=c["created_at"].isoformat(),
             completed_at=c["completed_at"].isoformat() if c.get("completed_at") else None
@@ -532,94 +2363,953 @@ async def list_checks(limit: int = 50) -> List[Check]:
         for c in checks
     ]
 
-@app.get("/api/agents/{agent_id}/tasks")
-async def get_agent_tasks(agent_id: str, limit: int = 10):
-    r = get_redis()
-    tasks = []
+ROLLUP_BUCKET_GAMMA = 1.2  # must match duration_bucket() in migration 5
+ROLLUP_PERCENTILES = (50, 90, 95, 99)
+ROLLUP_GROUP_COLUMNS = {"time": "bucket_start", "location": "location", "agent": "agent_id", "total": None}
+
+class RollupPoint(BaseModel):
+    bucket_start: Optional[str] = None
+    location: Optional[str] = None
+    agent_id: Optional[str] = None
+    count: int
+    success_ratio: float
+    min_ms: Optional[int] = None
+    max_ms: Optional[int] = None
+    avg_ms: Optional[float] = None
+    percentiles: Dict[str, float]
+
+def histogram_percentile(histogram: List[int], total: int, q: float, lo: int, hi: int) -> float:
+    rank = q * (total - 1)
+    seen = 0
+    for index, count in enumerate(histogram):
+        seen += count
+        if seen > rank:
+            # Midpoint of the bucket in relative terms, clamped to the exact extremes
+            value = 1.0 if index == 0 else 2 * ROLLUP_BUCKET_GAMMA ** index / (1 + ROLLUP_BUCKET_GAMMA)
+            return round(min(max(value, lo), hi), 1)
+    return float(hi)
+
+def _fetch_rollups(conn, granularity: str, target: str, check_type: Optional[str], location: Optional[str],
+                   agent_id: Optional[str], since: datetime, until: datetime, group_by: str):
+    conditions = ["granularity = %s", "target = %s", "bucket_start >= date_trunc(%s, %s::timestamp)", "bucket_start < %s"]
+    params = [granularity, target, granularity, since, until]
+    for column, value in (("check_type", check_type), ("location", location), ("agent_id", agent_id)):
+        if value is not None:
+            conditions.append(f"{column} = %s")
+            params.append(value)
     
-    for _ in range(limit):
-        task_json = r.rpop(f"agent:{agent_id}:tasks")
-        if not task_json:
-            break
-        tasks.append(json.loads(task_json))
+    group_column = ROLLUP_GROUP_COLUMNS[group_by]
+    key = f"{group_column} AS key," if group_column else ""
+    grouping = f"GROUP BY {group_column} ORDER BY {group_column}" if group_column else ""
     
-    return {"tasks": tasks}
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    cursor.execute(f"""
+        SELECT {key}
+               SUM(total_count) AS total_count, SUM(success_count) AS success_count,
+               MIN(min_ms) AS min_ms, MAX(max_ms) AS max_ms, SUM(sum_ms) AS sum_ms,
+               histogram_sum(histogram) AS histogram
+        FROM check_result_rollups
+        WHERE {" AND ".join(conditions)}
+        {grouping}
+    """, params)
+    rows = cursor.fetchall()
+    cursor.close()
+    return rows
 
-@app.post("/api/v1/results")
-async def submit_result(report: AgentResultReport):
-    result_str = str(report.result)
-    if len(result_str) > 100000:
-        raise HTTPException(status_code=413, detail="Result data too large")
+def rollup_point(row, group_by: str) -> RollupPoint:
+    total = int(row["total_count"] or 0)
+    successes = int(row["success_count"] or 0)
+    key = row.get("key")
+    # Successes that reported no duration_ms leave min_ms/max_ms NULL
+    timed = successes and row["min_ms"] is not None
+    point = RollupPoint(
+        count=total,
+        success_ratio=round(successes / total, 4) if total else 0.0,
+        min_ms=row["min_ms"],
+        max_ms=row["max_ms"],
+        avg_ms=round(int(row["sum_ms"]) / successes, 1) if timed else None,
+        percentiles={
+            f"p{p}": histogram_percentile(row["histogram"], successes, p / 100, row["min_ms"], row["max_ms"])
+            for p in ROLLUP_PERCENTILES
+        } if timed else {}
+    )
+    if group_by == "time":
+        point.bucket_start = key.isoformat()
+    elif group_by == "location":
+        point.location = key
+    elif group_by == "agent":
+        point.agent_id = key
+    return point
+
+@app.get("/api/rollups", response_model=List[RollupPoint])
+async def get_rollups(
+    target: str,
+    check_type: Optional[str] = None,
+    location: Optional[str] = None,
+    agent_id: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    granularity: Optional[str] = None,
+    group_by: str = "time"
+):
+    if group_by not in ROLLUP_GROUP_COLUMNS:
+        raise HTTPException(status_code=400, detail=f"group_by must be one of: {', '.join(ROLLUP_GROUP_COLUMNS)}")
     
-    conn = get_db()
+    # Rollup buckets are stored in server-local time like every other timestamp
+    until = until.astimezone().replace(tzinfo=None) if until and until.tzinfo else until or datetime.now()
+    since = since.astimezone().replace(tzinfo=None) if since and since.tzinfo else since or until - timedelta(days=1)
+    if since >= until:
+        raise HTTPException(status_code=400, detail="since must be before until")
+    
+    if granularity is None:
+        granularity = "minute" if until - since <= timedelta(hours=ROLLUP_MINUTE_MAX_RANGE_HOURS) else "hour"
+    elif granularity not in ("minute", "hour"):
+        raise HTTPException(status_code=400, detail="granularity must be minute or hour")
+    
+    rows = await run_db(_fetch_rollups, granularity, target, check_type, location, agent_id, since, until, group_by)
+    return [rollup_point(row, group_by) for row in rows if row["total_count"]]
+
+class CreateScheduleRequest(BaseModel):
+    target: str = Field(..., description="URL, IP или домен для проверки")
+    checks: List[str] = Field(..., description="Типы проверок: http, ping, dns, tcp, traceroute")
+    agents: Optional[List[str]] = Field(None, description="ID агентов (если None - все доступные)")
+    interval_seconds: int = Field(..., description="Период запуска в секундах")
+    jitter_seconds: int = Field(0, description="Случайный сдвиг каждого запуска, 0..jitter секунд")
+
+class Schedule(BaseModel):
+    id: str
+    target: str
+    check_types: List[str]
+    agent_ids: Optional[List[str]] = None
+    interval_seconds: int
+    jitter_seconds: int
+    enabled: bool
+    next_run_at: str
+    last_run_at: Optional[str] = None
+    last_check_id: Optional[str] = None
+
+SCHEDULE_COLUMNS = """
+    id, target, check_types, agent_ids, interval_seconds, jitter_seconds,
+    enabled, next_run_at, last_run_at, last_check_id, updated_at
+"""
+
+def schedule_from_row(row) -> Schedule:
+    return Schedule(
+        id=row["id"],
+        target=row["target"],
+        check_types=row["check_types"],
+        agent_ids=row["agent_ids"],
+        interval_seconds=row["interval_seconds"],
+        jitter_seconds=row["jitter_seconds"],
+        enabled=row["enabled"],
+        next_run_at=row["next_run_at"].isoformat(),
+        last_run_at=row["last_run_at"].isoformat() if row["last_run_at"] else None,
+        last_check_id=row["last_check_id"]
+    )
+
+def _insert_schedule(conn, schedule_id: str, request: CreateScheduleRequest, first_run: datetime):
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    cursor.execute(f"""
+        INSERT INTO check_schedules (id, target, check_types, agent_ids, interval_seconds, jitter_seconds, next_run_at)
+        VALUES (%s, %s, %s, %s, %s, %s, %s)
+        RETURNING {SCHEDULE_COLUMNS}
+    """, (schedule_id, request.target, json.dumps(request.checks),
+          json.dumps(request.agents) if request.agents else None,
+          request.interval_seconds, request.jitter_seconds, first_run))
+    row = cursor.fetchone()
+    cursor.close()
+    return row
+
+def _fetch_schedules(conn, changed_since: Optional[datetime], enabled_only: bool):
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    if changed_since is not None:
+        cursor.execute(f"SELECT {SCHEDULE_COLUMNS} FROM check_schedules WHERE updated_at >= %s",
+                       (changed_since,))
+    elif enabled_only:
+        cursor.execute(f"SELECT {SCHEDULE_COLUMNS} FROM check_schedules WHERE enabled")
+    else:
+        cursor.execute(f"SELECT {SCHEDULE_COLUMNS} FROM check_schedules ORDER BY created_at DESC")
+    rows = cursor.fetchall()
+    cursor.close()
+    return rows
+
+def _disable_schedule(conn, schedule_id: str) -> bool:
     cursor = conn.cursor()
+    cursor.execute("""
+        UPDATE check_schedules
+        SET enabled = FALSE, updated_at = CURRENT_TIMESTAMP
+        WHERE id = %s AND enabled
+        RETURNING id
+    """, (schedule_id,))
+    found = cursor.fetchone() is not None
+    cursor.close()
+    return found
+
+def _record_scheduled_runs(conn, checks: List[tuple], next_runs: List[tuple]):
+    cursor = conn.cursor()
+    if checks:
+        execute_values(cursor, """
+            INSERT INTO checks (id, target, check_types, agent_ids, status)
+            VALUES %s
+        """, [(c[0], c[1], json.dumps(c[2]), json.dumps(c[3]), "in_progress") for c in checks],
+            page_size=len(checks))
+    # Deliberately leaves updated_at alone: only API edits bump it
+    execute_values(cursor, """
+        UPDATE check_schedules s
+        SET next_run_at = to_timestamp(v.next_run)::timestamp,
+            last_run_at = CURRENT_TIMESTAMP,
+            last_check_id = COALESCE(v.check_id, s.last_check_id)
+        FROM (VALUES %s) AS v(id, next_run, check_id)
+        WHERE s.id = v.id
+    """, next_runs, template="(%s, %s::float8, %s::varchar)", page_size=len(next_runs))
+    cursor.close()
+
+@app.post("/api/schedules")
+async def create_schedule(request: CreateScheduleRequest) -> Schedule:
+    if not validate_target(request.target):
+        raise HTTPException(status_code=400, detail="Invalid target format")
     
-    cursor.execute("SELECT id FROM agents WHERE id = %s", (report.UIID,))
-    if not cursor.fetchone():
-        cursor.close()
+    if not validate_check_types(request.checks):
+        raise HTTPException(status_code=400, detail="Invalid check types")
+    
+    if request.interval_seconds < SCHEDULE_MIN_INTERVAL:
+        raise HTTPException(status_code=400, detail=f"interval_seconds must be at least {SCHEDULE_MIN_INTERVAL}")
+    
+    if not 0 <= request.jitter_seconds <= request.interval_seconds:
+        raise HTTPException(status_code=400, detail="jitter_seconds must be between 0 and interval_seconds")
+    
+    # Spread the first run over one interval so bulk-created schedules
+    # don't all fire on the same tick
+    first_run = datetime.fromtimestamp(time.time() + random.uniform(0, request.interval_seconds))
+    row = await run_db(_insert_schedule, str(uuid.uuid4()), request, first_run)
+    return schedule_from_row(row)
+
+@app.get("/api/schedules")
+async def list_schedules() -> List[Schedule]:
+    rows = await run_db(_fetch_schedules, None, False)
+    return [schedule_from_row(row) for row in rows]
+
+@app.delete("/api/schedules/{schedule_id}")
+async def delete_schedule(schedule_id: str):
+    if not await run_db(_disable_schedule, schedule_id):
+        raise HTTPException(status_code=404, detail="Schedule not found")
+    return {"status": "ok", "schedule_id": schedule_id}
+
+SCHEDULER_LEADER_KEY = "scheduler:leader"
+SCHEDULER_WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+RENEW_LEADERSHIP_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+RELEASE_LEADERSHIP_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+class RecurringCheckScheduler:
+    """Min-heap of due times for enabled schedules, run only by the elected leader.
+
+    Heap entries carry a per-schedule generation so edits and deletions just
+    push a new entry; stale ones are skipped when popped.
+    """
+
+    def __init__(self):
+        self.is_leader = False
+        self.renew_at = 0.0
+        self.emitted = 0
+        self.reset()
+
+    def reset(self):
+        self.schedules: Dict[str, Dict] = {}
+        self.generations: Dict[str, int] = {}
+        self.heap: List[Tuple[float, str, int]] = []
+        self.changed_since: Optional[datetime] = None
+        self.reload_at = 0.0
+
+    async def hold_leadership(self) -> bool:
+        now = time.monotonic()
+        if self.is_leader and now < self.renew_at:
+            return True
+        
+        r = get_async_redis()
+        ttl_ms = int(SCHEDULER_LEADER_TTL * 1000)
+        if self.is_leader:
+            leader = bool(await r.eval(RENEW_LEADERSHIP_SCRIPT, 1, SCHEDULER_LEADER_KEY, SCHEDULER_WORKER_ID, ttl_ms))
+        else:
+            leader = bool(await r.set(SCHEDULER_LEADER_KEY, SCHEDULER_WORKER_ID, nx=True, px=ttl_ms))
+        
+        if leader != self.is_leader:
+            print(f"⏱️  Scheduler leadership {'acquired' if leader else 'lost'} by {SCHEDULER_WORKER_ID}")
+            self.reset()
+        self.is_leader = leader
+        self.renew_at = now + SCHEDULER_LEADER_TTL / 3
+        return leader
+
+    async def release_leadership(self):
+        if self.is_leader:
+            await get_async_redis().eval(RELEASE_LEADERSHIP_SCRIPT, 1, SCHEDULER_LEADER_KEY, SCHEDULER_WORKER_ID)
+            self.is_leader = False
+
+    def _push(self, schedule_id: str, run_at: float):
+        generation = self.generations.get(schedule_id, 0) + 1
+        self.generations[schedule_id] = generation
+        heapq.heappush(self.heap, (run_at, schedule_id, generation))
+
+    async def reload(self):
+        # Reads only what changed since the last reload (with some overlap
+        # for late commits); unchanged rows are recognised by updated_at.
+        rows = await run_db(_fetch_schedules, self.changed_since, True)
+        now = time.time()
+        for row in rows:
+            known = self.schedules.get(row["id"])
+            if known is not None and known["updated_at"] == row["updated_at"]:
+                continue
+            if not row["enabled"]:
+                self.schedules.pop(row["id"], None)
+                self.generations.pop(row["id"], None)
+                continue
+            self.schedules[row["id"]] = row
+            run_at = row["next_run_at"].timestamp()
+            if run_at < now:
+                run_at = now + random.uniform(0, row["jitter_seconds"] or min(row["interval_seconds"], 5))
+            self._push(row["id"], run_at)
+        
+        latest = max((row["updated_at"] for row in rows), default=self.changed_since)
+        if latest is not None:
+            self.changed_since = latest - timedelta(seconds=SCHEDULER_RELOAD_INTERVAL)
+        self.reload_at = time.monotonic() + SCHEDULER_RELOAD_INTERVAL
+
+    async def run_due(self):
+        now = time.time()
+        due = []
+        next_runs = []
+        while self.heap and self.heap[0][0] <= now and len(due) < SCHEDULER_BATCH_SIZE:
+            run_at, schedule_id, generation = heapq.heappop(self.heap)
+            if self.generations.get(schedule_id) != generation:
+                continue
+            schedule = self.schedules[schedule_id]
+            # Missed runs are skipped rather than replayed back to back
+            next_run = max(run_at + schedule["interval_seconds"], now) + random.uniform(0, schedule["jitter_seconds"])
+            self._push(schedule_id, next_run)
+            due.append(schedule)
+            next_runs.append((schedule_id, next_run))
+        
+        if due:
+            await emit_scheduled_checks(due, next_runs)
+            self.emitted += len(due)
+
+    async def tick(self):
+        if time.monotonic() >= self.reload_at:
+            await self.reload()
+        await self.run_due()
+        
+        delay = 1.0
+        if self.heap:
+            delay = min(delay, max(0.0, self.heap[0][0] - time.time()))
+        await asyncio.sleep(delay)
+
+async def emit_scheduled_checks(due: List[Dict], next_runs: List[tuple]):
+    online = await get_online_agents()
+    checks = []
+    check_by_schedule = {}
+    for schedule in due:
+        if schedule["agent_ids"]:
+            agent_ids = [a for a in schedule["agent_ids"] if a in online]
+        else:
+            agent_ids = agent_load.select(list(online), tasks_per_agent=len(schedule["check_types"]))
+        if not agent_ids:
+            continue
+        check_id = str(uuid.uuid4())
+        checks.append((check_id, schedule["target"], schedule["check_types"], agent_ids))
+        check_by_schedule[schedule["id"]] = check_id
+    
+    next_runs = [(schedule_id, next_run, check_by_schedule.get(schedule_id)) for schedule_id, next_run in next_runs]
+    await run_db(_record_scheduled_runs, checks, next_runs)
+    
+    if checks:
+        async with get_async_redis().pipeline(transaction=False) as pipe:
+            for check_id, target, check_types, agent_ids in checks:
+                queue_check_tasks(pipe, check_id, target, check_types, agent_ids)
+            await pipe.execute()
+
+check_scheduler = RecurringCheckScheduler()
+
+async def run_check_scheduler():
+    try:
+        while True:
+            try:
+                if await check_scheduler.hold_leadership():
+                    await check_scheduler.tick()
+                else:
+                    await asyncio.sleep(SCHEDULER_LEADER_TTL / 3)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Scheduler error: {e}")
+                await asyncio.sleep(1)
+    finally:
+        try:
+            await check_scheduler.release_leadership()
+        except Exception:
+            pass
+
+@app.get("/api/agents/{agent_id}/tasks")
+async def get_agent_tasks(agent_id: str, limit: int = 10, wait: float = 0):
+    if agent_id not in await known_agents([agent_id]):
         raise HTTPException(status_code=403, detail="Unknown agent")
     
-    cursor.close()
+    limit = max(1, min(limit, TASK_FETCH_MAX_LIMIT))
+    wait = max(0.0, min(wait, TASK_LONG_POLL_MAX_WAIT))
+    
+    if TASK_QUEUE_BACKEND == "stream":
+        return {"tasks": await pop_stream_tasks(agent_id, limit, wait)}
     
-    result_id = str(uuid.uuid4())
+    r = get_async_redis()
     
-    conn = get_db()
+    # Either call pops up to `limit` tasks atomically in one round trip.
+    # With wait > 0, BLMPOP parks the request on Redis (not the event loop)
+    # until work arrives or the timeout passes.
+    if wait > 0:
+        popped = await r.blmpop(wait, 1, agent_queue_key(agent_id), direction="RIGHT", count=limit)
+        entries = popped[1] if popped else []
+    else:
+        entries = await r.rpop(agent_queue_key(agent_id), limit) or []
+    
+    return {"tasks": await resolve_agent_tasks(agent_id, entries)}
+
+def _insert_results(conn, rows: List[tuple]) -> Dict[str, int]:
+    """Stores what it can of rows; returns result id -> ms from check creation to the result."""
+    # One multi-row statement per batch. Results are only taken for checks
+    # still in progress, and at most once per (check, agent, type): a task
+    # redelivered from a stream, or a late answer to a check the sweeper
+    # already timed out, is skipped instead of being counted twice.
+    # The same statement folds the inserted rows into the minute and hour
+    # rollups; the ORDER BY keeps lock order stable across concurrent batches.
     cursor = conn.cursor()
+    # Share-locking the checks keeps the sweeper from completing one under
+    # us, and the advisory locks make concurrent reports of the same task
+    # wait for each other. Both are taken before the insert so its snapshot
+    # already sees whatever the locks waited for.
+    cursor.execute("""
+        SELECT id FROM checks
+        WHERE id = ANY(%s) AND status = 'in_progress'
+        ORDER BY id
+        FOR KEY SHARE
+    """, (sorted({row[1] for row in rows}),))
+    live = {row[0] for row in cursor.fetchall()}
+    rows = [row for row in rows if row[1] in live]
+    if not rows:
+        cursor.close()
+        return {}
+    cursor.execute("""
+        SELECT pg_advisory_xact_lock(hashtextextended(k, 0)) FROM unnest(%s::text[]) AS k
+    """, (sorted({f"{row[1]}:{row[2]}:{row[3]}" for row in rows}),))
     
+    inserted = execute_values(cursor, """
+        WITH inserted AS (
+            INSERT INTO check_results (id, check_id, agent_id, check_type, success, data, error, duration_ms)
+            SELECT DISTINCT ON (v.check_id, v.agent_id, v.check_type)
+                   v.id, v.check_id, v.agent_id, v.check_type, v.success, v.data::jsonb, v.error, v.duration_ms
+            FROM (VALUES %s) AS v(id, check_id, agent_id, check_type, success, data, error, duration_ms)
+            WHERE NOT EXISTS (
+                SELECT 1 FROM check_results cr
+                WHERE cr.check_id = v.check_id AND cr.agent_id = v.agent_id AND cr.check_type = v.check_type
+            )
+            RETURNING id, check_id, agent_id, check_type, success, duration_ms, created_at
+        ), rolled AS (
+            INSERT INTO check_result_rollups AS r (
+                granularity, bucket_start, target, check_type, agent_id, location,
+                total_count, success_count, min_ms, max_ms, sum_ms, histogram
+            )
+            SELECT g.granularity, date_trunc(g.granularity, i.created_at), c.target, i.check_type,
+                   i.agent_id, a.location,
+                   COUNT(*), COUNT(*) FILTER (WHERE i.success),
+                   MIN(i.duration_ms) FILTER (WHERE i.success),
+                   MAX(i.duration_ms) FILTER (WHERE i.success),
+                   COALESCE(SUM(i.duration_ms) FILTER (WHERE i.success), 0),
+                   duration_histogram(array_agg(duration_bucket(i.duration_ms)) FILTER (WHERE i.success))
+            FROM inserted i
+            JOIN checks c ON c.id = i.check_id
+            JOIN agents a ON a.id = i.agent_id
+            CROSS JOIN (VALUES ('minute'), ('hour')) AS g(granularity)
+            GROUP BY 1, 2, 3, 4, 5, 6
+            ORDER BY 1, 3, 4, 5, 2
+            ON CONFLICT (granularity, target, check_type, agent_id, bucket_start) DO UPDATE SET
+                total_count = r.total_count + EXCLUDED.total_count,
+                success_count = r.success_count + EXCLUDED.success_count,
+                min_ms = LEAST(r.min_ms, EXCLUDED.min_ms),
+                max_ms = GREATEST(r.max_ms, EXCLUDED.max_ms),
+                sum_ms = r.sum_ms + EXCLUDED.sum_ms,
+                histogram = merge_histograms(r.histogram, EXCLUDED.histogram)
+        )
+        SELECT i.id, (EXTRACT(EPOCH FROM i.created_at - c.created_at) * 1000)::bigint
+        FROM inserted i
+        JOIN checks c ON c.id = i.check_id
+    """, rows, page_size=len(rows), fetch=True)
+    cursor.close()
+    return dict(inserted)
+
+DURATION_MS_MAX = 2 ** 31 - 1  # INTEGER column
+
+def coerce_duration_ms(value) -> Optional[int]:
+    """Agent-reported response_time_ms as an int; anything unusable becomes None."""
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, str):
+        try:
+            value = float(value)
+        except ValueError:
+            return None
+    if not isinstance(value, (int, float)) or value != value or not 0 <= value <= DURATION_MS_MAX:
+        return None
+    return int(value)
+
+def build_result_row(report: AgentResultReport) -> tuple:
+    """Raises ValueError for a report Postgres can't store, so one bad report can't fail a batch."""
     try:
         result_data = json.loads(report.result) if isinstance(report.result, str) else report.result
-        success = True
-        error = None
-        duration_ms = result_data.get("response_time_ms", 0) if isinstance(result_data, dict) else 0
+        # Agents report a failed probe as a bare false
+        success = result_data is not False
+        error = None if success else "Check failed"
+        duration_ms = coerce_duration_ms(result_data.get("response_time_ms", 0)) if isinstance(result_data, dict) else 0
     except (json.JSONDecodeError, ValueError, TypeError):
         result_data = {"raw": report.result}
         success = "error" not in report.result.lower() and "failed" not in report.result.lower()
         error = report.result if not success else None
         duration_ms = 0
     
-    cursor.execute("""
-        INSERT INTO check_results (id, check_id, agent_id, check_type, success, data, error, duration_ms)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-    """, (result_id, report.taskUIID, report.UIID, report.task, 
-          success, json.dumps(result_data), error, duration_ms))
+    # jsonb rejects NaN/Infinity and \u0000
+    try:
+        data = json.dumps(result_data, allow_nan=False)
+    except ValueError:
+        raise ValueError("Result contains NaN or Infinity")
+    if "\\u0000" in data or "\x00" in (error or ""):
+        raise ValueError("Result contains NUL characters")
     
-    conn.commit()
+    return (str(uuid.uuid4()), report.taskUIID, report.UIID, report.task,
+            success, data, error, duration_ms)
+
+# Decrements the per-check counter only if it exists; a missing counter
+# (expired, or a check created before counters existed) returns nil.
+DECREMENT_REMAINING_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return false
+end
+return redis.call('DECRBY', KEYS[1], ARGV[1])
+"""
+
+def _complete_check(conn, check_id: str):
+    cursor = conn.cursor()
+    cursor.execute("""
+        UPDATE checks
+        SET status = 'completed', completed_at = CURRENT_TIMESTAMP
+        WHERE id = %s AND status = 'in_progress'
+        RETURNING completed_at, created_at
+    """, (check_id,))
+    row = cursor.fetchone()
+    cursor.close()
+    return row
+
+def _complete_check_by_count(conn, check_id: str):
+    cursor = conn.cursor()
+    cursor.execute("""
+        UPDATE checks c
+        SET status = 'completed', completed_at = CURRENT_TIMESTAMP
+        WHERE c.id = %s AND c.status = 'in_progress'
+          AND (SELECT COUNT(*) FROM check_results cr WHERE cr.check_id = c.id)
+              >= jsonb_array_length(c.check_types) * jsonb_array_length(COALESCE(c.agent_ids, '[]'::jsonb))
+        RETURNING completed_at, created_at
+    """, (check_id,))
+    row = cursor.fetchone()
     cursor.close()
+    return row
+
+async def record_check_progress(check_id: str, received: int):
+    remaining = await get_async_redis().eval(DECREMENT_REMAINING_SCRIPT, 1, check_remaining_key(check_id), received)
     
-    r = get_redis()
-    r.publish(f"check:{report.taskUIID}:updates", json.dumps({
-        "type": "result",
-        "check_id": report.taskUIID,
-        "agent_id": report.UIID,
-        "check_type": report.task
-    }))
+    if remaining is None:
+        completed = await run_db(_complete_check_by_count, check_id)
+    elif remaining <= 0 < remaining + received:
+        # Only the report that takes the counter across zero finalizes
+        completed = await run_db(_complete_check, check_id)
+    else:
+        return
     
-    return {"status": "ok", "result_id": result_id}
+    if completed is None:
+        return
+    completed_at, created_at = completed
+    check_completion_duration.observe((completed_at - created_at).total_seconds(), "completed")
+    
+    async with get_async_redis().pipeline(transaction=False) as pipe:
+        pipe.delete(check_remaining_key(check_id), check_reassigned_key(check_id))
+        pipe.publish(f"check:{check_id}:updates", json.dumps({
+            "type": "completed",
+            "check_id": check_id,
+            "completed_at": completed_at.isoformat()
+        }))
+        await pipe.execute()
+
+async def record_results_progress(rows: List[tuple]):
+    received: Dict[str, int] = {}
+    for row in rows:
+        received[row[1]] = received.get(row[1], 0) + 1
+    await asyncio.gather(*(record_check_progress(c, n) for c, n in received.items()))
+
+async def publish_result_updates(rows: List[tuple], latencies: Optional[Dict[str, int]] = None):
+    """Notifies check subscribers; latencies (from _insert_results) feed the agent load view."""
+    by_check: Dict[str, List[Dict]] = {}
+    for row in rows:
+        by_check.setdefault(row[1], []).append({"agent_id": row[2], "check_type": row[3]})
+    
+    async with get_async_redis().pipeline(transaction=False) as pipe:
+        for check_id, results in by_check.items():
+            if len(results) == 1:
+                message = {"type": "result", "check_id": check_id, **results[0]}
+            else:
+                message = {"type": "results", "check_id": check_id, "count": len(results), "results": results}
+            pipe.publish(f"check:{check_id}:updates", json.dumps(message))
+        if latencies:
+            record_agent_latency(pipe, rows, latencies)
+        await pipe.execute()
+
+@app.post("/api/v1/results")
+async def submit_result(report: AgentResultReport):
+    result_str = str(report.result)
+    if len(result_str) > RESULT_MAX_SIZE:
+        raise HTTPException(status_code=413, detail="Result data too large")
+    
+    if report.UIID not in await known_agents([report.UIID]):
+        raise HTTPException(status_code=403, detail="Unknown agent")
+    
+    try:
+        row = build_result_row(report)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    inserted = await run_db(_insert_results, [row])
+    # Acknowledged either way, so a rejected task isn't redelivered
+    await acknowledge_results([row])
+    
+    if not inserted:
+        raise HTTPException(status_code=404, detail="Check not found or not accepting this result")
+    
+    results_ingested.inc(1, "agent")
+    await publish_result_updates([row], inserted)
+    await record_results_progress([row])
+    
+    return {"status": "ok", "result_id": row[0]}
+
+result_reports_adapter = TypeAdapter(List[AgentResultReport])
+
+@app.post("/api/v1/results/batch")
+async def submit_results_batch(request: Request):
+    """Accepts a JSON array or an NDJSON stream (application/x-ndjson) of result reports."""
+    body = await request.body()
+    
+    try:
+        if "ndjson" in request.headers.get("content-type", ""):
+            items = [json.loads(line) for line in body.splitlines() if line.strip()]
+        else:
+            items = json.loads(body)
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        raise HTTPException(status_code=400, detail="Malformed JSON")
+    
+    if not isinstance(items, list):
+        raise HTTPException(status_code=400, detail="Expected an array of results")
+    if len(items) > RESULT_BATCH_MAX_SIZE:
+        raise HTTPException(status_code=413, detail=f"Batch exceeds {RESULT_BATCH_MAX_SIZE} results")
+    if not items:
+        return {"status": "ok", "accepted": 0, "result_ids": [], "rejected": []}
+    
+    try:
+        reports = result_reports_adapter.validate_python(items)
+    except ValidationError as e:
+        raise HTTPException(status_code=422, detail=e.errors(include_url=False))
+    
+    rejected = []
+    candidates = []
+    for index, report in enumerate(reports):
+        if len(str(report.result)) > RESULT_MAX_SIZE:
+            rejected.append({"index": index, "error": "Result data too large"})
+        else:
+            candidates.append((index, report))
+    
+    known = await known_agents([report.UIID for _, report in candidates])
+    rows = []
+    row_indexes = []
+    for index, report in candidates:
+        if report.UIID not in known:
+            rejected.append({"index": index, "error": "Unknown agent"})
+            continue
+        try:
+            rows.append(build_result_row(report))
+        except ValueError as e:
+            rejected.append({"index": index, "error": str(e)})
+            continue
+        row_indexes.append(index)
+    
+    inserted = await run_db(_insert_results, rows) if rows else {}
+    # Acknowledged either way, so a rejected task isn't redelivered
+    await acknowledge_results(rows)
+    accepted = []
+    for index, row in zip(row_indexes, rows):
+        if row[0] in inserted:
+            accepted.append(row)
+        else:
+            rejected.append({"index": index, "error": "Check not found or not accepting this result"})
+    
+    if accepted:
+        results_ingested.inc(len(accepted), "agent")
+        await publish_result_updates(accepted, inserted)
+        await record_results_progress(accepted)
+    
+    return {
+        "status": "ok",
+        "accepted": len(accepted),
+        "result_ids": [row[0] for row in accepted],
+        "rejected": sorted(rejected, key=lambda r: r["index"])
+    }
+
+TASK_TIMEOUT_ERRORS = {
+    "expired": "Task expired before the agent picked it up",
+    "dropped": "Task dropped: agent queue is full",
+    "orphaned": "Task timed out: agent went offline"
+}
+
+def _expire_stale_checks(conn, max_age: int, limit: int) -> Tuple[List[tuple], List[tuple]]:
+    """Times out whatever a long-running check is still waiting for and completes it."""
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT id FROM checks
+        WHERE status = 'in_progress' AND created_at < CURRENT_TIMESTAMP - %s * INTERVAL '1 second'
+        ORDER BY created_at
+        LIMIT %s
+        FOR UPDATE SKIP LOCKED
+    """, (max_age, limit))
+    check_ids = [row[0] for row in cursor.fetchall()]
+    if not check_ids:
+        cursor.close()
+        return [], []
+    
+    # An (agent, type) pair is missing only if that type is also short of
+    # results overall, so a task answered by a reassigned agent isn't
+    # timed out a second time
+    cursor.execute("""
+        WITH expected AS (
+            SELECT c.id AS check_id, t.check_type, a.agent_id,
+                   jsonb_array_length(COALESCE(c.agent_ids, '[]'::jsonb)) AS agents
+            FROM checks c
+            CROSS JOIN LATERAL jsonb_array_elements_text(c.check_types) AS t(check_type)
+            CROSS JOIN LATERAL jsonb_array_elements_text(COALESCE(c.agent_ids, '[]'::jsonb)) AS a(agent_id)
+            WHERE c.id = ANY(%s)
+        )
+        SELECT e.check_id, e.agent_id, e.check_type
+        FROM expected e
+        WHERE EXISTS (SELECT 1 FROM agents ag WHERE ag.id = e.agent_id)
+          AND NOT EXISTS (
+              SELECT 1 FROM check_results cr
+              WHERE cr.check_id = e.check_id AND cr.agent_id = e.agent_id AND cr.check_type = e.check_type
+          )
+          AND (SELECT COUNT(*) FROM check_results cr
+               WHERE cr.check_id = e.check_id AND cr.check_type = e.check_type) < e.agents
+    """, (check_ids,))
+    rows = [
+        (str(uuid.uuid4()), check_id, agent_id, check_type, False,
+         json.dumps({"status": "timeout"}), "Task timed out: no result before the deadline", 0)
+        for check_id, agent_id, check_type in cursor.fetchall()
+    ]
+    if rows:
+        _insert_results(conn, rows)
+    
+    cursor.execute("""
+        UPDATE checks
+        SET status = 'completed', completed_at = CURRENT_TIMESTAMP
+        WHERE id = ANY(%s) AND status = 'in_progress'
+        RETURNING id, completed_at, created_at
+    """, (check_ids,))
+    completed = cursor.fetchall()
+    cursor.close()
+    return rows, completed
+
+def _fetch_check_agents(conn, check_ids: List[str]) -> Dict[str, Set[str]]:
+    """Agents each in-progress check was sent to; finished checks are left out."""
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT id, COALESCE(agent_ids, '[]'::jsonb) FROM checks
+        WHERE id = ANY(%s) AND status = 'in_progress'
+    """, (check_ids,))
+    agents = {row[0]: set(row[1]) for row in cursor.fetchall()}
+    cursor.close()
+    return agents
+
+class TaskSweeper:
+    """Reassigns or times out dead-lettered and orphaned tasks, and closes stuck checks."""
+
+    def __init__(self):
+        self.reassigned = 0
+        self.timed_out = 0
+        self.expired_checks = 0
+
+    async def take_orphaned_queues(self):
+        r = get_async_redis()
+        offline = await r.zrangebyscore(HEARTBEATS_KEY, "-inf", time.time() - TASK_ORPHAN_AFTER)
+        if not offline:
+            return
+        async with r.pipeline(transaction=False) as pipe:
+            for agent_id in offline:
+                queue_depth(pipe, agent_id)
+            depths = await pipe.execute()
+        for agent_id, depth in zip(offline, depths):
+            if depth:
+                await take_agent_queue(r, agent_id)
+
+    async def drain_dead_letters(self) -> int:
+        entries = await get_async_redis().rpop(TASKS_DEAD_LETTER_KEY, TASK_SWEEP_BATCH) or []
+        if not entries:
+            return 0
+        
+        parsed = []
+        for entry in entries:
+            reason, agent_id, ref = entry.split("|", 2)
+            if ref.startswith("{"):
+                task = json.loads(ref)
+                ref = f"{task['check_id']}:{task['check_type']}"
+            parsed.append((reason, agent_id, ref))
+        await agent_load.ensure_locations(list({agent_id for _, agent_id, _ in parsed}))
+        # An agent that already has a task of the check could end up
+        # reporting a duplicate, which is dropped and leaves the check waiting
+        # for its deadline, so those agents are never picked as replacements
+        check_agents = await run_db(_fetch_check_agents, list({parse_task_ref(ref)[0] for _, _, ref in parsed}))
+        async with get_async_redis().pipeline(transaction=False) as pipe:
+            for check_id in check_agents:
+                pipe.smembers(check_reassigned_key(check_id))
+            for check_id, reassigned in zip(list(check_agents), await pipe.execute()):
+                check_agents[check_id] |= reassigned
+        
+        now = time.time()
+        moves: Dict[str, List[str]] = {}
+        rows = []
+        for reason, agent_id, ref in parsed:
+            check_id, check_type, deadline = parse_task_ref(ref)
+            replacement = None
+            if reason != "expired" and (deadline is None or deadline > now) and check_id in check_agents:
+                replacement = agent_load.replacement_for(agent_id, check_agents[check_id])
+            if replacement:
+                moves.setdefault(replacement, []).append(ref)
+                check_agents[check_id].add(replacement)
+                continue
+            rows.append((str(uuid.uuid4()), check_id, agent_id, check_type, False,
+                         json.dumps({"status": "timeout", "reason": reason}), TASK_TIMEOUT_ERRORS[reason], 0))
+        
+        if moves:
+            async with get_async_redis().pipeline(transaction=False) as pipe:
+                for agent_id, refs in moves.items():
+                    for check_id in {parse_task_ref(ref)[0] for ref in refs}:
+                        pipe.sadd(check_reassigned_key(check_id), agent_id)
+                        pipe.expire(check_reassigned_key(check_id), CHECK_COUNTER_TTL)
+                    push_agent_tasks(pipe, agent_id, refs)
+                await pipe.execute()
+            self.reassigned += sum(len(refs) for refs in moves.values())
+        
+        known = await known_agents([row[2] for row in rows])
+        rows = [row for row in rows if row[2] in known]
+        if rows:
+            inserted = await run_db(_insert_results, rows)
+            accepted = [row for row in rows if row[0] in inserted]
+            if accepted:
+                results_ingested.inc(len(accepted), "timeout")
+                await publish_result_updates(accepted)
+                await record_results_progress(accepted)
+                self.timed_out += len(accepted)
+        return len(entries)
+
+    async def expire_stale_checks(self):
+        rows, completed = await run_db(_expire_stale_checks, TASK_DEADLINE + CHECK_RESULT_GRACE, TASK_SWEEP_BATCH)
+        if rows:
+            await publish_result_updates(rows)
+            results_ingested.inc(len(rows), "timeout")
+            self.timed_out += len(rows)
+        if not completed:
+            return
+        async with get_async_redis().pipeline(transaction=False) as pipe:
+            for check_id, completed_at, created_at in completed:
+                check_completion_duration.observe((completed_at - created_at).total_seconds(), "timed_out")
+                pipe.delete(check_remaining_key(check_id), check_reassigned_key(check_id))
+                pipe.publish(f"check:{check_id}:updates", json.dumps({
+                    "type": "completed",
+                    "check_id": check_id,
+                    "completed_at": completed_at.isoformat()
+                }))
+            await pipe.execute()
+        self.expired_checks += len(completed)
+
+    async def sweep(self):
+        await self.take_orphaned_queues()
+        while await self.drain_dead_letters() == TASK_SWEEP_BATCH:
+            pass
+        if TASK_DEADLINE > 0:
+            await self.expire_stale_checks()
+
+task_sweeper = TaskSweeper()
+
+async def run_task_sweeper():
+    while True:
+        await asyncio.sleep(TASK_SWEEP_INTERVAL)
+        try:
+            await task_sweeper.sweep()
+        except Exception as e:
+            print(f"Task sweeper error: {e}")
 
 @app.websocket("/api/ws/checks/{check_id}")
 async def websocket_check_updates(websocket: WebSocket, check_id: str):
     await websocket.accept()
     
-    r = get_redis()
-    pubsub = r.pubsub()
-    pubsub.subscribe(f"check:{check_id}:updates")
+    queue = check_updates_hub.subscribe(check_id)
     
-    try:
+    async def send_updates():
         while True:
-            message = pubsub.get_message(timeout=1.0)
-            if message and message["type"] == "message":
-                await websocket.send_text(message["data"])
-            await asyncio.sleep(0.1)
-    except WebSocketDisconnect:
-        pubsub.unsubscribe(f"check:{check_id}:updates")
-        pubsub.close()
+            data = await queue.get()
+            if data is None:
+                await websocket.close(code=1013)
+                return
+            await websocket.send_text(data)
+    
+    async def wait_for_disconnect():
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                return
+    
+    tasks = [asyncio.create_task(send_updates()), asyncio.create_task(wait_for_disconnect())]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        check_updates_hub.unsubscribe(check_id, queue)
 
 @app.post("/takeReport")
 async def take_report_legacy(report: AgentResultReport):
     return await submit_result(report)
 
 if __name__ == "__main__":
+    import sys
+    
+    if sys.argv[1:] == ["migrate"]:
+        with get_db() as conn:
+            applied = run_migrations(conn)
+        close_db()
+        print(f"✅ Migrations applied: {applied}" if applied else "✅ Schema is up to date")
+        sys.exit(0)
+    
     import uvicorn
+    MIGRATE_ON_STARTUP = True
     port = int(os.getenv("PORT", "8000"))
     uvicorn.run(app, host="0.0.0.0", port=port)
 
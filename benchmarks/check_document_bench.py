@@ -0,0 +1,102 @@
+"""
+Compares the two get_check render paths on one large check:
+CHECK_JSON_IN_DB (the document is built by Postgres) against the Python path
+(row dicts, isoformat() and pydantic serialization).
+
+    DATABASE_URL=postgresql://... python benchmarks/check_document_bench.py --results 10000
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import backend_main  # noqa: E402
+from backend_main import CreateCheckRequest, RegisterAgentRequest, get_db, run_db  # noqa: E402
+
+CHECK_TYPES = ["http", "ping", "dns", "tcp", "traceroute"]
+BATCH = 1000
+
+def seed(conn, results: int):
+    # _insert_results keeps one result per (agent, check type), so every
+    # seeded row gets a pair of its own
+    check_id = str(uuid.uuid4())
+    agent_ids = [str(uuid.uuid4()) for _ in range(-(-results // len(CHECK_TYPES)))]
+    for i, agent_id in enumerate(agent_ids):
+        backend_main._insert_agent(conn, agent_id, RegisterAgentRequest(name=f"bench-{i}", location="Bench"),
+                                   uuid.uuid4().hex)
+    request = CreateCheckRequest(target="bench.example.com", checks=CHECK_TYPES)
+    backend_main._insert_check(conn, check_id, request, agent_ids)
+    conn.commit()
+
+    rows = []
+    for i in range(results):
+        agent_id, check_type = agent_ids[i // len(CHECK_TYPES)], CHECK_TYPES[i % len(CHECK_TYPES)]
+        data = '{"response_time_ms": %d}' % (i % 500)
+        rows.append((str(uuid.uuid4()), check_id, agent_id, check_type, True, data, None, i % 500))
+        if len(rows) == BATCH:
+            backend_main._insert_results(conn, rows)
+            conn.commit()
+            rows = []
+    if rows:
+        backend_main._insert_results(conn, rows)
+        conn.commit()
+
+    cursor = conn.cursor()
+    cursor.execute("SELECT COUNT(*) FROM check_results WHERE check_id = %s", (check_id,))
+    stored = cursor.fetchone()[0]
+    cursor.close()
+    if stored != results:
+        cleanup(conn, check_id, agent_ids)
+        conn.commit()
+        raise RuntimeError(f"seeded {stored} of {results} results")
+    return check_id, agent_ids
+
+def cleanup(conn, check_id: str, agent_ids: list):
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM checks WHERE id = %s", (check_id,))
+    cursor.execute("DELETE FROM check_result_rollups WHERE agent_id = ANY(%s)", (agent_ids,))
+    cursor.execute("DELETE FROM agents WHERE id = ANY(%s)", (agent_ids,))
+    cursor.close()
+
+async def measure(name: str, render, check_id: str, rounds: int):
+    timings = []
+    size = 0
+    for _ in range(rounds):
+        start = time.perf_counter()
+        body, _ = await render(check_id)
+        timings.append((time.perf_counter() - start) * 1000)
+        size = len(body)
+    print(f"{name:<10} median {statistics.median(timings):8.1f} ms  "
+          f"min {min(timings):8.1f} ms  max {max(timings):8.1f} ms  body {size / 1024:.0f} KiB")
+
+async def render_in_db(check_id: str):
+    return await run_db(backend_main._fetch_check_document, check_id)
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--results", type=int, default=10000)
+    parser.add_argument("--rounds", type=int, default=20)
+    args = parser.parse_args()
+
+    with get_db() as conn:
+        check_id, agent_ids = seed(conn, args.results)
+    print(f"📊 check {check_id} with {args.results} results, {args.rounds} rounds each")
+    try:
+        # One untimed pass each so both paths start with warm caches
+        await render_in_db(check_id)
+        await backend_main.render_check(check_id)
+        await measure("postgres", render_in_db, check_id, args.rounds)
+        await measure("python", backend_main.render_check, check_id, args.rounds)
+    finally:
+        with get_db() as conn:
+            cleanup(conn, check_id, agent_ids)
+        backend_main.close_db()
+
+if __name__ == "__main__":
+    asyncio.run(main())
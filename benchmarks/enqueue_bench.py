@@ -0,0 +1,93 @@
+"""
+Measures create_check enqueue latency for growing agent counts: the old
+one-LPUSH-per-(agent, check type) loop with a full JSON task against the
+pipelined enqueue_check_tasks path that create_check uses now.
+
+    REDIS_URL=redis://... python benchmarks/enqueue_bench.py --agents 10 200 1000
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import backend_main  # noqa: E402
+
+CHECK_TYPES = ["ping", "http", "tcp"]
+TARGET = "bench.example.com"
+
+def enqueue_per_pair(r, check_id: str, agent_ids: list):
+    for agent_id in agent_ids:
+        for check_type in CHECK_TYPES:
+            r.lpush(f"agent:{agent_id}:tasks", json.dumps({
+                "check_id": check_id,
+                "agent_id": agent_id,
+                "check_type": check_type,
+                "target": TARGET
+            }))
+
+async def enqueue_pipelined(check_id: str, agent_ids: list):
+    await backend_main.enqueue_check_tasks(check_id, TARGET, CHECK_TYPES, agent_ids)
+
+async def cleanup(agent_ids: list, check_ids: list):
+    keys = [backend_main.agent_queue_key(a) for a in agent_ids]
+    keys += [backend_main.agent_stream_key(a) for a in agent_ids]
+    keys += [backend_main.agent_inflight_key(a) for a in agent_ids]
+    keys += [backend_main.check_payload_key(c) for c in check_ids]
+    keys += [backend_main.check_remaining_key(c) for c in check_ids]
+    r = backend_main.get_async_redis()
+    for i in range(0, len(keys), 1000):
+        await r.delete(*keys[i:i + 1000])
+
+def report(name: str, agents: int, timings: list):
+    print(f"{agents:>6} agents  {name:<10} median {statistics.median(timings):8.2f} ms  "
+          f"min {min(timings):8.2f} ms  max {max(timings):8.2f} ms")
+
+async def run(agents: int, rounds: int):
+    agent_ids = [f"bench-agent-{i}" for i in range(agents)]
+    check_ids = []
+    sync_redis = backend_main.get_redis()
+    try:
+        old, new = [], []
+        for _ in range(rounds):
+            check_id = str(uuid.uuid4())
+            check_ids.append(check_id)
+            start = time.perf_counter()
+            # The old path blocked the event loop; run it the same way here
+            enqueue_per_pair(sync_redis, check_id, agent_ids)
+            old.append((time.perf_counter() - start) * 1000)
+            await cleanup(agent_ids, [])
+
+            check_id = str(uuid.uuid4())
+            check_ids.append(check_id)
+            start = time.perf_counter()
+            await enqueue_pipelined(check_id, agent_ids)
+            new.append((time.perf_counter() - start) * 1000)
+            await cleanup(agent_ids, [])
+        report("per-pair", agents, old)
+        report("pipelined", agents, new)
+    finally:
+        await cleanup(agent_ids, check_ids)
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--agents", type=int, nargs="+", default=[10, 200, 1000])
+    parser.add_argument("--rounds", type=int, default=20)
+    args = parser.parse_args()
+
+    print(f"📊 {len(CHECK_TYPES)} check types per check, {args.rounds} rounds, "
+          f"queue backend {backend_main.TASK_QUEUE_BACKEND}")
+    try:
+        for agents in args.agents:
+            await run(agents, args.rounds)
+    finally:
+        await backend_main.get_async_redis().aclose()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,82 @@
+"""
+Compares agent-side task throughput of the two queue backends: list (RPOP)
+against stream (POP_STREAM_SCRIPT followed by ACK_STREAM_SCRIPT once the
+result is in). Both queues are filled with the same refs before timing.
+
+    REDIS_URL=redis://... python benchmarks/queue_backend_bench.py --tasks 100000 --limit 10
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import backend_main  # noqa: E402
+from backend_main import ACK_STREAM_SCRIPT, ENQUEUE_STREAM_SCRIPT, ENQUEUE_TASKS_SCRIPT, POP_STREAM_SCRIPT  # noqa: E402
+
+FILL_CHUNK = 1000
+
+async def fill(script: str, key: str, agent_id: str, refs: list):
+    r = backend_main.get_async_redis()
+    async with r.pipeline(transaction=False) as pipe:
+        for i in range(0, len(refs), FILL_CHUNK):
+            pipe.eval(script, 2, key, backend_main.TASKS_DEAD_LETTER_KEY, agent_id, 0, "drop_oldest",
+                      *refs[i:i + FILL_CHUNK])
+        await pipe.execute()
+
+async def drain_list(agent_id: str, limit: int) -> int:
+    r = backend_main.get_async_redis()
+    popped = 0
+    while True:
+        entries = await r.rpop(backend_main.agent_queue_key(agent_id), limit)
+        if not entries:
+            return popped
+        popped += len(entries)
+
+async def drain_stream(agent_id: str, limit: int) -> int:
+    r = backend_main.get_async_redis()
+    stream, inflight = backend_main.agent_stream_key(agent_id), backend_main.agent_inflight_key(agent_id)
+    popped = 0
+    while True:
+        refs = await r.eval(POP_STREAM_SCRIPT, 2, stream, inflight, agent_id, limit,
+                            backend_main.TASK_CLAIM_TIMEOUT * 1000)
+        if not refs:
+            return popped
+        await r.eval(ACK_STREAM_SCRIPT, 2, stream, inflight, *[backend_main.task_key(ref) for ref in refs])
+        popped += len(refs)
+
+async def measure(name: str, drain, agent_id: str, tasks: int, limit: int):
+    start = time.perf_counter()
+    popped = await drain(agent_id, limit)
+    elapsed = time.perf_counter() - start
+    assert popped == tasks, f"{name}: popped {popped} of {tasks}"
+    print(f"{name:<7} {tasks / elapsed:10.0f} tasks/s  ({elapsed * 1000:.0f} ms)")
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tasks", type=int, default=100000)
+    parser.add_argument("--limit", type=int, default=10, help="tasks per fetch, like ?limit= on the tasks endpoint")
+    args = parser.parse_args()
+
+    agent_id = f"bench-agent-{uuid.uuid4().hex[:8]}"
+    deadline = int(time.time()) + 3600
+    refs = [f"{uuid.uuid4()}:ping:{deadline}" for _ in range(args.tasks)]
+    keys = [backend_main.agent_queue_key(agent_id), backend_main.agent_stream_key(agent_id),
+            backend_main.agent_inflight_key(agent_id)]
+    r = backend_main.get_async_redis()
+    print(f"📊 {args.tasks} tasks, {args.limit} per fetch")
+    try:
+        await fill(ENQUEUE_TASKS_SCRIPT, keys[0], agent_id, refs)
+        await measure("list", drain_list, agent_id, args.tasks, args.limit)
+        await fill(ENQUEUE_STREAM_SCRIPT, keys[1], agent_id, refs)
+        await measure("stream", drain_stream, agent_id, args.tasks, args.limit)
+    finally:
+        await r.delete(*keys)
+        await r.aclose()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,15 +1,20 @@
 from pydantic import BaseModel
 import requests
 import socket
+import ssl
 import time
 import threading
 import uuid
 import os
 import json
-from pythonping import ping as pping
+import struct
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from urllib.parse import urlsplit
 from typing import List, Union
 from fastapi import FastAPI
-from scapy.all import IP, ICMP, sr1
+from scapy.all import IP, ICMP, sr
 from scapy.layers.inet import UDP
 from dotenv import load_dotenv
 load_dotenv()
@@ -21,132 +26,597 @@ agentUUID = os.getenv("agentUUID")
 agentcountry = os.getenv("country")
 masterIPandPort = os.getenv("masterIPandPort")
 
-newTasks = []
-completedTasks = []
+completedTasks = None
+runningTasks = set()
 
-backTHRWork = True
+# Checks that run on probe threads; coroutine probes only wait on sockets
+# and get their own, much larger cap
+MAX_CONCURRENT_TASKS = int(os.getenv("MAX_CONCURRENT_TASKS", "10"))
+ASYNC_MAX_CONCURRENT_TASKS = int(os.getenv("ASYNC_MAX_CONCURRENT_TASKS", "1000"))
+# Extra per-type caps on top of the above, e.g. "traceroute=2,ping=50"
+TASK_TYPE_LIMITS = {
+    name.strip(): int(limit)
+    for name, limit in (item.split("=") for item in os.getenv("TASK_TYPE_LIMITS", "traceroute=2").split(",") if "=" in item)
+}
+
+taskSlots = None
+asyncTaskSlots = None
+typeSlots = {}
+probeExecutor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_TASKS, thread_name_prefix="probe")
+
+# Results go to the backend's batch endpoint: up to RESULT_BATCH_SIZE per
+# request, waiting at most RESULT_FLUSH_INTERVAL to fill a batch
+RESULT_BATCH_SIZE = int(os.getenv("RESULT_BATCH_SIZE", "500"))
+RESULT_FLUSH_INTERVAL = float(os.getenv("RESULT_FLUSH_INTERVAL", "0.5"))
+RESULT_SEND_TIMEOUT = float(os.getenv("RESULT_SEND_TIMEOUT", "10"))
+RESULT_MAX_PARALLEL_SENDS = int(os.getenv("RESULT_MAX_PARALLEL_SENDS", "4"))
+RESULT_SEND_RETRIES = int(os.getenv("RESULT_SEND_RETRIES", "3"))
+
+resultSender = None
+sendSlots = None
+sendingTasks = set()
+resultSession = requests.Session()
 
 MAX_HOPS = 30
 TRACE_PORT = 80
 HOP_TIMEOUT = 1.0
+TRACE_TIMEOUT = float(os.getenv("TRACE_TIMEOUT", "2"))
+# TTLs probed at once; paths shorter than this finish in one TRACE_TIMEOUT
+TRACE_WAVE_SIZE = int(os.getenv("TRACE_WAVE_SIZE", "16"))
+DNS_CACHE_TTL = float(os.getenv("DNS_CACHE_TTL", "300"))
+PING_COUNT = int(os.getenv("PING_COUNT", "3"))
+PING_TIMEOUT = float(os.getenv("PING_TIMEOUT", "2"))
+PING_INTERVAL = float(os.getenv("PING_INTERVAL", "0.2"))
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "5"))
+HTTP_KEEPALIVE_IDLE = float(os.getenv("HTTP_KEEPALIVE_IDLE", "30"))
+# Pooled keep-alive connections across all hosts; each one holds an fd
+HTTP_MAX_IDLE_CONNECTIONS = int(os.getenv("HTTP_MAX_IDLE_CONNECTIONS", "256"))
+TCP_TIMEOUT = float(os.getenv("TCP_TIMEOUT", "3"))
+TCP_DEFAULT_PORTS = os.getenv("TCP_DEFAULT_PORTS", "80,443")
+TCP_MAX_PORTS = int(os.getenv("TCP_MAX_PORTS", "1024"))
+TCP_MAX_PARALLEL_CONNECTS = int(os.getenv("TCP_MAX_PARALLEL_CONNECTS", "500"))
+# RFC 8305 "connection attempt delay" between racing addresses
+TCP_HAPPY_EYEBALLS_DELAY = float(os.getenv("TCP_HAPPY_EYEBALLS_DELAY", "0.25"))
 
-def backgroundSender():
-    global backTHRWork
-    global completedTasks
-    while backTHRWork:
-        if completedTasks != []:
-            print(completedTasks[0])
-            body = {
-                "country": str(agentcountry),
-                "UIID": str(agentUUID),
-                "taskUIID": str(completedTasks[0]['taskUUID']),
-                "result": str(completedTasks[0]['result'])
-            }
-            req = requests.post(url=f"{masterIPandPort}/takeReport", data=json.dumps(body))
-
-            completedTasks.pop(0)
-        else:
-            time.sleep(1)
-
-def backgroundTasker():
-    global newTasks
-    global completedTasks
-    global backTHRWork
-    while backTHRWork:
-        if newTasks != []:
-            print(newTasks)
-            match newTasks[0]["task"]:
-                case "http(s)":
-                    taskTocomplete = newTasks[0]
-                    taskTocomplete["result"] = check_http_https(newTasks[0]["target"])
-                    completedTasks.append(taskTocomplete)
-                case "ping":
-                    taskTocomplete = newTasks[0]
-                    taskTocomplete["result"] = check_ping(newTasks[0]["target"])
-                    completedTasks.append(taskTocomplete)
-                case "tcp":
-                    taskTocomplete = newTasks[0]
-                    taskTocomplete["result"] = check_tcp_port(newTasks[0]["target"])
-                    completedTasks.append(taskTocomplete)
-                case "traceroute":
-                    taskTocomplete = newTasks[0]
-                    taskTocomplete["result"] = check_traceroute(newTasks[0]["target"])
-                    completedTasks.append(taskTocomplete)
-                case _:
-                    return {"error": "Unknown task"}
-            newTasks.pop(0)
+tcpConnectSlots = None
+
+# (scheme, host, port) -> [(reader, writer, idle since)], oldest first
+idleConnections = {}
+idleSweeper = None
+sslContext = ssl.create_default_context()
+
+dnsCache = {}
+dnsCacheLock = threading.Lock()
+
+def report_body(task) -> dict:
+    return {
+        "country": str(agentcountry),
+        "UIID": str(agentUUID),
+        "taskUIID": str(task["taskUUID"]),
+        "task": task["task"],
+        "target": task["target"],
+        # The backend parses this as JSON; str() would send a Python repr
+        "result": json.dumps(task["result"])
+    }
+
+def post_results(batch: list):
+    response = resultSession.post(f"{masterIPandPort}/api/v1/results/batch",
+                                  json=[report_body(task) for task in batch], timeout=RESULT_SEND_TIMEOUT)
+    response.raise_for_status()
+    rejected = response.json().get("rejected", [])
+    if rejected:
+        print(f"Backend rejected {len(rejected)} of {len(batch)} results: {rejected[:3]}")
+
+async def send_results(batch: list):
+    # requests blocks, so each batch goes out on a worker thread; a hung
+    # backend costs one send slot for RESULT_SEND_TIMEOUT, not all reporting
+    try:
+        await asyncio.to_thread(post_results, batch)
+        return
+    except (requests.RequestException, ValueError) as e:
+        error = e
+    finally:
+        sendSlots.release()
+    retry = [task for task in batch if task.setdefault("attempts", 0) < RESULT_SEND_RETRIES]
+    print(f"Result upload failed ({error}); retrying {len(retry)} of {len(batch)}")
+    if retry:
+        await asyncio.sleep(max(task["attempts"] for task in retry) + 1)
+        for task in retry:
+            task["attempts"] += 1
+            completedTasks.put_nowait(task)
+
+async def take_result_batch() -> list:
+    batch = [await completedTasks.get()]
+    deadline = time.monotonic() + RESULT_FLUSH_INTERVAL
+    while len(batch) < RESULT_BATCH_SIZE:
+        if completedTasks.empty():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(completedTasks.get(), remaining))
+            except asyncio.TimeoutError:
+                break
         else:
-            time.sleep(1)
+            batch.append(completedTasks.get_nowait())
+    return batch
+
+async def send_completed_tasks():
+    while True:
+        batch = await take_result_batch()
+        await sendSlots.acquire()
+        sending = asyncio.create_task(send_results(batch))
+        sendingTasks.add(sending)
+        sending.add_done_callback(sendingTasks.discard)
+
+async def runTask(task):
+    # The type slot is taken first, so tasks held back by their own type's
+    # cap don't sit on global slots that other types could use
+    check = CHECKS[task["task"]]
+    isAsync = asyncio.iscoroutinefunction(check)
+    async with typeSlots.get(task["task"], nullcontext()):
+        async with asyncTaskSlots if isAsync else taskSlots:
+            try:
+                if isAsync:
+                    task["result"] = await check(task["target"])
+                else:
+                    task["result"] = await asyncio.get_running_loop().run_in_executor(probeExecutor, check, task["target"])
+            except Exception:
+                task["result"] = False
+    completedTasks.put_nowait(task)
 
 @app.on_event("startup")
 async def startDBConnection():
-    threading.Thread(target=backgroundTasker).start()
-    threading.Thread(target=backgroundSender).start()
-    pass
+    global taskSlots, asyncTaskSlots, idleSweeper, completedTasks, sendSlots, resultSender
+    taskSlots = asyncio.Semaphore(MAX_CONCURRENT_TASKS)
+    asyncTaskSlots = asyncio.Semaphore(ASYNC_MAX_CONCURRENT_TASKS)
+    for name, limit in TASK_TYPE_LIMITS.items():
+        typeSlots[name] = asyncio.Semaphore(limit)
+    idleSweeper = asyncio.create_task(sweep_idle_connections())
+    completedTasks = asyncio.Queue()
+    sendSlots = asyncio.Semaphore(RESULT_MAX_PARALLEL_SENDS)
+    resultSender = asyncio.create_task(send_completed_tasks())
 
 @app.on_event("shutdown")
 async def stopDBConnection():
-    global backTHRWork
-    backTHRWork = False
-
-def check_http_https(host: str):
-    protocols = ['https://', 'http://']
-    timeout = 5
-    
-    for proto in protocols:
-        url = proto + host
+    if resultSender is not None:
+        resultSender.cancel()
+    for task in list(runningTasks):
+        task.cancel()
+    # Uploads in flight are bounded by RESULT_SEND_TIMEOUT; whatever
+    # finished but wasn't sent yet gets one last attempt
+    await asyncio.gather(*sendingTasks, return_exceptions=True)
+    leftover = []
+    while completedTasks is not None and not completedTasks.empty():
+        leftover.append(completedTasks.get_nowait())
+    for i in range(0, len(leftover), RESULT_BATCH_SIZE):
         try:
-            start_time = time.time()
-            requests.head(url, timeout=timeout, allow_redirects=True)
-            elapsed_time = (time.time() - start_time) * 1000
-            return round(elapsed_time)
-        except requests.exceptions.RequestException:
-            continue
-            
-    return False
-
-def check_ping(host: str):
-    try:
-        response_list = pping(host, count=3, timeout=2, verbose=False)
-        if response_list.success():
-            return round(response_list.rtt_avg_ms)
+            await asyncio.to_thread(post_results, leftover[i:i + RESULT_BATCH_SIZE])
+        except (requests.RequestException, ValueError) as e:
+            print(f"Dropping {len(leftover[i:i + RESULT_BATCH_SIZE])} unsent results: {e}")
+    if idleSweeper is not None:
+        idleSweeper.cancel()
+    close_idle_connections(closeAll=True)
+    probeExecutor.shutdown(wait=False, cancel_futures=True)
+
+def connection_usable(reader, writer, idleSince: float, now: float) -> bool:
+    return now - idleSince < HTTP_KEEPALIVE_IDLE and not reader.at_eof() and not writer.is_closing()
+
+def take_idle_connection(key):
+    pool = idleConnections.get(key)
+    now = time.monotonic()
+    while pool:
+        reader, writer, idleSince = pool.pop()
+        if connection_usable(reader, writer, idleSince, now):
+            return reader, writer
+        writer.close()
+    idleConnections.pop(key, None)
+    return None
+
+def park_idle_connection(key, reader, writer):
+    if HTTP_MAX_IDLE_CONNECTIONS <= 0:
+        writer.close()
+        return
+    if sum(len(pool) for pool in idleConnections.values()) >= HTTP_MAX_IDLE_CONNECTIONS:
+        # Make room by closing whichever connection has been idle longest
+        oldest = min(idleConnections, key=lambda k: idleConnections[k][0][2])
+        idleConnections[oldest].pop(0)[1].close()
+        if not idleConnections[oldest]:
+            del idleConnections[oldest]
+    idleConnections.setdefault(key, []).append((reader, writer, time.monotonic()))
+
+def close_idle_connections(closeAll: bool = False):
+    """Closes pooled connections past HTTP_KEEPALIVE_IDLE or dropped by the server."""
+    now = time.monotonic()
+    for key, pool in list(idleConnections.items()):
+        kept = []
+        for reader, writer, idleSince in pool:
+            if not closeAll and connection_usable(reader, writer, idleSince, now):
+                kept.append((reader, writer, idleSince))
+            else:
+                writer.close()
+        if kept:
+            idleConnections[key] = kept
+        else:
+            del idleConnections[key]
+
+async def sweep_idle_connections():
+    # Hosts that are never probed again would otherwise keep their fds forever
+    while True:
+        await asyncio.sleep(HTTP_KEEPALIVE_IDLE / 2)
+        close_idle_connections()
+
+def elapsed_ms(since: float) -> float:
+    return round((time.perf_counter() - since) * 1000, 2)
+
+async def http_probe(scheme: str, host: str, port: int, path: str) -> dict:
+    """One HEAD request with per-phase timings; reuses an idle keep-alive connection when there is one."""
+    key = (scheme, host, port)
+    hostHeader = f"[{host}]" if ":" in host else host
+    if port != (443 if scheme == "https" else 80):
+        hostHeader += f":{port}"
+    request = (f"HEAD {path} HTTP/1.1\r\nHost: {hostHeader}\r\nUser-Agent: hostchecker-agent\r\n"
+               f"Accept: */*\r\nConnection: keep-alive\r\n\r\n").encode()
+
+    for attempt in range(2):
+        timings = {"dns_ms": None, "connect_ms": None, "tls_ms": None}
+        start = time.perf_counter()
+        connection = take_idle_connection(key) if attempt == 0 else None
+        reused = connection is not None
+        writer = None
+        try:
+            if reused:
+                reader, writer = connection
+            else:
+                phase = time.perf_counter()
+                infos = await asyncio.get_running_loop().getaddrinfo(host, port, type=socket.SOCK_STREAM)
+                timings["dns_ms"] = elapsed_ms(phase)
+                address = infos[0][4]
+                phase = time.perf_counter()
+                reader, writer = await asyncio.open_connection(address[0], address[1])
+                timings["connect_ms"] = elapsed_ms(phase)
+                if scheme == "https":
+                    phase = time.perf_counter()
+                    await writer.start_tls(sslContext, server_hostname=host)
+                    timings["tls_ms"] = elapsed_ms(phase)
+
+            phase = time.perf_counter()
+            writer.write(request)
+            await writer.drain()
+            statusLine = await reader.readline()
+            if not statusLine:
+                raise ConnectionResetError("connection closed before response")
+            timings["ttfb_ms"] = elapsed_ms(phase)
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+            version, status = statusLine.decode("latin-1").split()[:2]
+            status = int(status)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            if writer is not None:
+                writer.close()
+            if reused:
+                # The server dropped the idle connection; retry on a fresh one
+                continue
+            raise
+        except BaseException:
+            # Cancelled by wait_for (possibly mid-TLS) or a malformed status line
+            if writer is not None:
+                writer.close()
+            raise
+
+        timings["total_ms"] = elapsed_ms(start)
+        # HEAD responses carry no body, so the connection is ready for reuse
+        if version == "HTTP/1.1" and headers.get("connection", "").lower() != "close":
+            park_idle_connection(key, reader, writer)
         else:
+            writer.close()
+        return {"status": status, "reused": reused, **timings,
+                **({"location": headers["location"]} if "location" in headers else {})}
+
+async def timed_http_probe(scheme: str, host: str, port: int, path: str) -> dict:
+    try:
+        return await asyncio.wait_for(http_probe(scheme, host, port, path), HTTP_TIMEOUT)
+    except asyncio.TimeoutError:
+        return {"error": f"timeout after {HTTP_TIMEOUT}s"}
+    except (OSError, ValueError, ssl.SSLError) as e:
+        return {"error": str(e) or type(e).__name__}
+
+async def check_http_https(target: str):
+    # Both schemes are probed at once, so an HTTP-only host no longer waits
+    # out the HTTPS timeout first
+    parsed = urlsplit(target if "://" in target else "//" + target)
+    schemes = [parsed.scheme] if parsed.scheme in ("http", "https") else ["https", "http"]
+    path = parsed.path or "/"
+    if parsed.query:
+        path += "?" + parsed.query
+    try:
+        explicitPort = parsed.port
+    except ValueError:
+        return False
+    if not parsed.hostname:
+        return False
+
+    results = await asyncio.gather(*(
+        timed_http_probe(scheme, parsed.hostname, explicitPort or (443 if scheme == "https" else 80), path)
+        for scheme in schemes
+    ))
+    if all("error" in result for result in results):
+        return False
+    winner = next(result for result in results if "error" not in result)
+    return {**dict(zip(schemes, results)), "response_time_ms": winner["total_ms"]}
+
+def icmp_checksum(data: bytes) -> int:
+    if len(data) % 2:
+        data += b"\0"
+    total = sum(struct.unpack(f"!{len(data) // 2}H", data))
+    total = (total >> 16) + (total & 0xFFFF)
+    total += total >> 16
+    return ~total & 0xFFFF
+
+class PingEngine:
+    """One ICMP socket shared by every ping task; replies are matched by identifier and sequence."""
+
+    def __init__(self):
+        self.loop = asyncio.get_running_loop()
+        try:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP)
+            self.raw = True
+        except PermissionError:
+            # Unprivileged ping socket: the kernel rewrites the identifier
+            # and only hands this socket its own replies
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP)
+            self.raw = False
+        self.sock.setblocking(False)
+        self.ident = os.getpid() & 0xFFFF
+        self.seq = 0
+        self.pending = {}
+        self.loop.add_reader(self.sock.fileno(), self.on_readable)
+
+    def on_readable(self):
+        while True:
+            try:
+                data, (src, _) = self.sock.recvfrom(2048)
+            except (BlockingIOError, InterruptedError):
+                return
+            received_at = time.perf_counter()
+            if self.raw:
+                data = data[(data[0] & 0x0F) * 4:]
+            if len(data) < 8:
+                continue
+            icmp_type, _, _, ident, seq = struct.unpack("!BBHHH", data[:8])
+            if icmp_type != 0 or (self.raw and ident != self.ident):
+                continue
+            probe = self.pending.get(seq)
+            if probe is None or probe[0] != src:
+                continue
+            del self.pending[seq]
+            _, sent_at, future, timer = probe
+            timer.cancel()
+            if not future.done():
+                future.set_result((received_at - sent_at) * 1000)
+
+    def expire(self, seq: int, future):
+        probe = self.pending.get(seq)
+        if probe is not None and probe[2] is future:
+            del self.pending[seq]
+        if not future.done():
+            future.set_result(None)
+
+    async def probe(self, ip: str, timeout: float):
+        self.seq = (self.seq + 1) & 0xFFFF
+        seq = self.seq
+        payload = b"hostchecker".ljust(48, b"\0")
+        checksum = icmp_checksum(struct.pack("!BBHHH", 8, 0, 0, self.ident, seq) + payload)
+        packet = struct.pack("!BBHHH", 8, 0, checksum, self.ident, seq) + payload
+
+        while True:
+            try:
+                self.sock.sendto(packet, (ip, 0))
+                break
+            except BlockingIOError:
+                await asyncio.sleep(0.001)
+            except OSError:
+                return None
+
+        # Registered after the send: replies are only read once we yield
+        future = self.loop.create_future()
+        timer = self.loop.call_later(timeout, self.expire, seq, future)
+        self.pending[seq] = (ip, time.perf_counter(), future, timer)
+        return await future
+
+    async def ping(self, ip: str, count: int, timeout: float, interval: float) -> dict:
+        probes = []
+        for i in range(count):
+            if i:
+                await asyncio.sleep(interval)
+            probes.append(asyncio.ensure_future(self.probe(ip, timeout)))
+        rtts = [rtt for rtt in await asyncio.gather(*probes) if rtt is not None]
+        return {
+            "ip": ip,
+            "sent": count,
+            "received": len(rtts),
+            "loss": round(100 * (count - len(rtts)) / count, 1),
+            "min_ms": round(min(rtts), 2) if rtts else None,
+            "avg_ms": round(sum(rtts) / len(rtts), 2) if rtts else None,
+            "max_ms": round(max(rtts), 2) if rtts else None,
+        }
+
+pingEngine = None
+
+async def resolve_cached_async(host: str) -> str:
+    now = time.time()
+    cached = dnsCache.get(host)
+    if cached and cached[1] > now:
+        return cached[0]
+    infos = await asyncio.get_running_loop().getaddrinfo(host, None, family=socket.AF_INET, type=socket.SOCK_STREAM)
+    ip = infos[0][4][0]
+    with dnsCacheLock:
+        dnsCache[host] = (ip, now + DNS_CACHE_TTL)
+    return ip
+
+async def check_ping(host: str):
+    global pingEngine
+    try:
+        if pingEngine is None or pingEngine.loop is not asyncio.get_running_loop():
+            pingEngine = PingEngine()
+        ip = await resolve_cached_async(host)
+        result = await pingEngine.ping(ip, PING_COUNT, PING_TIMEOUT, PING_INTERVAL)
+        if result["received"] == 0:
             return False
+        return {**result, "response_time_ms": result["avg_ms"]}
     except Exception:
         return False
 
-def check_tcp_port(host: str):
-    addr = host.split(":")
+def parse_tcp_target(target: str):
+    """Splits "host:80,443,8000-8010" (or "[v6]:ports", or a bare host) into a host and a port list."""
+    if target.startswith("["):
+        host, _, rest = target[1:].partition("]")
+        spec = rest[1:] if rest.startswith(":") else ""
+    elif target.count(":") > 1:
+        # Bare IPv6 literal: every colon belongs to the address
+        host, spec = target, ""
+    else:
+        host, _, spec = target.partition(":")
+
+    ports = []
+    for item in (spec or TCP_DEFAULT_PORTS).split(","):
+        first, _, last = item.strip().partition("-")
+        low = int(first)
+        high = int(last) if last else low
+        if not 1 <= low <= high <= 65535:
+            raise ValueError(f"invalid port range: {item}")
+        ports.extend(range(low, high + 1))
+    ports = list(dict.fromkeys(ports))
+    if len(ports) > TCP_MAX_PORTS:
+        raise ValueError(f"more than {TCP_MAX_PORTS} ports")
+    return host, ports
+
+def interleave_addresses(infos) -> list:
+    # IPv6 first, then alternate families, as RFC 8305 suggests
+    v6 = list(dict.fromkeys(info[4][0] for info in infos if info[0] == socket.AF_INET6))
+    v4 = list(dict.fromkeys(info[4][0] for info in infos if info[0] == socket.AF_INET))
+    ordered = []
+    for i in range(max(len(v6), len(v4))):
+        ordered += [(socket.AF_INET6, a) for a in v6[i:i + 1]] + [(socket.AF_INET, a) for a in v4[i:i + 1]]
+    return ordered
+
+async def tcp_connect(family: int, ip: str, port: int, delay: float):
+    await asyncio.sleep(delay)
+    loop = asyncio.get_running_loop()
+    # The socket is only opened once a slot is free, so a big scan never
+    # holds more than TCP_MAX_PARALLEL_CONNECTS fds, and the timeout only
+    # covers the connect itself, not the wait for a slot
+    async with tcpConnectSlots:
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        try:
+            start = time.perf_counter()
+            await asyncio.wait_for(loop.sock_connect(sock, (ip, port)), TCP_TIMEOUT)
+            return ip, round((time.perf_counter() - start) * 1000, 2)
+        finally:
+            sock.close()
+
+async def happy_eyeballs_connect(addresses: list, port: int) -> dict:
+    """Races the addresses with staggered starts; the first successful connect wins."""
+    attempts = [
+        asyncio.create_task(tcp_connect(family, ip, port, i * TCP_HAPPY_EYEBALLS_DELAY))
+        for i, (family, ip) in enumerate(addresses)
+    ]
+    error = None
     try:
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.settimeout(3)
-        start_time = time.time()
-        result = sock.connect_ex((addr[0], int(addr[1])))
-        elapsed_time = (time.time() - start_time) * 1000
-        sock.close()
-        if result == 0:
-            return round(elapsed_time)
+        for attempt in asyncio.as_completed(attempts):
+            try:
+                ip, connectMs = await attempt
+            except (OSError, asyncio.TimeoutError) as e:
+                error = e
+                continue
+            return {"open": True, "ip": ip, "connect_ms": connectMs}
+        if isinstance(error, asyncio.TimeoutError):
+            reason = "timeout"
+        elif isinstance(error, ConnectionRefusedError):
+            reason = "refused"
         else:
-            return False
-    except Exception:
+            reason = str(error) or type(error).__name__
+        return {"open": False, "error": reason}
+    finally:
+        for attempt in attempts:
+            attempt.cancel()
+
+async def check_tcp_port(target: str):
+    global tcpConnectSlots
+    try:
+        host, ports = parse_tcp_target(target)
+        infos = await asyncio.get_running_loop().getaddrinfo(host, None, type=socket.SOCK_STREAM)
+    except (ValueError, OSError):
+        return False
+    if tcpConnectSlots is None:
+        tcpConnectSlots = asyncio.Semaphore(TCP_MAX_PARALLEL_CONNECTS)
+
+    addresses = interleave_addresses(infos)
+    # Every port is probed at once; up to TCP_MAX_PARALLEL_CONNECTS ports a
+    # scan takes about one TCP_TIMEOUT
+    results = await asyncio.gather(*(happy_eyeballs_connect(addresses, port) for port in ports))
+    openPorts = [port for port, result in zip(ports, results) if result["open"]]
+    if not openPorts:
         return False
+    return {
+        "response_time_ms": min(result["connect_ms"] for result in results if result["open"]),
+        "host": host,
+        "addresses": [ip for _, ip in addresses],
+        "open_ports": openPorts,
+        "ports": {str(port): result for port, result in zip(ports, results)},
+    }
 
-def manual_traceroute(destination: str, max_hops: int = 30) -> List[str]:
-    reply_list = []
+def resolve_cached(host: str) -> str:
+    now = time.time()
+    with dnsCacheLock:
+        cached = dnsCache.get(host)
+        if cached and cached[1] > now:
+            return cached[0]
+    ip = socket.gethostbyname(host)
+    with dnsCacheLock:
+        dnsCache[host] = (ip, now + DNS_CACHE_TTL)
+    return ip
+
+def manual_traceroute(destination: str, max_hops: int = 30) -> List[dict]:
     try:
-        destination_ip = socket.gethostbyname(destination)
+        destination_ip = resolve_cached(destination)
     except socket.gaierror:
         return 
 
-    for ttl in range(1, max_hops + 1):
-        packet = IP(dst=destination_ip, ttl=ttl) / UDP(dport=33434)
-        reply = sr1(packet, verbose=0, timeout=2)
-        if reply is None:
-            continue
-        reply_list.append(reply.src)
-        if reply.type == 3:
+    # Every TTL of a wave goes out at once. Each probe gets its own
+    # destination port, so the UDP header quoted back in the ICMP reply
+    # tells which TTL it answers.
+    hops = []
+    sport = 33000 + os.getpid() % 1000
+    for first in range(1, max_hops + 1, TRACE_WAVE_SIZE):
+        ttls = range(first, min(first + TRACE_WAVE_SIZE, max_hops + 1))
+        packets = [IP(dst=destination_ip, ttl=ttl) / UDP(sport=sport, dport=33434 + ttl) for ttl in ttls]
+        answered, _ = sr(packets, verbose=0, timeout=TRACE_TIMEOUT)
+
+        replies = {sent[IP].ttl: (sent, reply) for sent, reply in answered}
+        reached = False
+        for ttl in ttls:
+            if ttl not in replies:
+                hops.append({"ttl": ttl, "ip": None, "rtt_ms": None})
+                continue
+            sent, reply = replies[ttl]
+            hops.append({"ttl": ttl, "ip": reply.src, "rtt_ms": round((reply.time - sent.sent_time) * 1000, 2)})
+            if reply.src == destination_ip or (reply.haslayer(ICMP) and reply[ICMP].type == 3):
+                reached = True
+                break
+        if reached:
             break
-    return reply_list
+
+    # Silent hops past the last answer are noise, not path
+    while hops and hops[-1]["ip"] is None:
+        hops.pop()
+    return hops
 
 
 def check_traceroute(host: str):
@@ -159,6 +629,13 @@ def check_traceroute(host: str):
     except Exception:
         return False
 
+CHECKS = {
+    "http(s)": check_http_https,
+    "ping": check_ping,
+    "tcp": check_tcp_port,
+    "traceroute": check_traceroute,
+}
+
 # === Модели запросов ===
 
 class reportFromAgent(BaseModel):
@@ -175,13 +652,17 @@ class checkRequest(BaseModel):
 # === Основное API ===
 
 @app.post("/check")
-def check(validReq: checkRequest):
+async def check(validReq: checkRequest):
+    if validReq.task not in CHECKS:
+        return {"error": "Unknown task"}
     newTask = {
         "target": validReq.target,
         "task": validReq.task,
         "taskUUID": validReq.taskUUID
     }
-    newTasks.append(newTask)
+    running = asyncio.create_task(runTask(newTask))
+    runningTasks.add(running)
+    running.add_done_callback(runningTasks.discard)
 
 # === Локальное тестирование ===
 
@@ -191,13 +672,13 @@ if __name__ == '__main__':
     print(f"Тестирование хоста: {HOST_TO_TEST}")
 
     # 1. HTTP/HTTPS
-    print(f"HTTP/HTTPS: {check_http_https(HOST_TO_TEST)}")
+    print(f"HTTP/HTTPS: {asyncio.run(check_http_https(HOST_TO_TEST))}")
 
     # 2. Ping
-    print(f"Ping: {check_ping(HOST_TO_TEST)}")
+    print(f"Ping: {asyncio.run(check_ping(HOST_TO_TEST))}")
 
     # 3. TCP-порт
-    print(f"TCP: {check_tcp_port(f'{HOST_TO_TEST}:443')}")
+    print(f"TCP: {asyncio.run(check_tcp_port(f'{HOST_TO_TEST}:80,443'))}")
 
     # 4. Traceroute
     print(f"Traceroute: {check_traceroute(HOST_TO_TEST)}")
\ No newline at end of file